@@ -3,17 +3,24 @@
 
 import argparse
 import collections
+import concurrent.futures
 import configparser
 import contextlib
 import getpass
 import logging
+import multiprocessing
 import os
+import queue
 import random
+import re
 import shlex
 import shutil
+import signal
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import traceback
 import types
 
@@ -21,8 +28,10 @@ import pkg_resources
 
 from reprotest.lib import adtlog
 from reprotest.lib import adt_testbed
+from reprotest.lib import VirtSubproc
 from reprotest.build import Build, VariationSpec, Variations, tool_missing
-from reprotest import environ, presets, shell_syn
+from reprotest import compare, diffcache, diffoscope_server, environ, presets, results, shell_syn, store, stream
+from reprotest.utils import sha256sums
 
 logger = logging.getLogger(__name__)
 
@@ -64,13 +73,23 @@ class Testbed(adt_testbed.Testbed):
                       adtlog.AutopkgtestError)
         return out
 
+    def check_output(self, argv, kind='short', xenv=[]):
+        """Like check_exec2(stdout=True), but return stdout as undecoded bytes."""
+        with tempfile.TemporaryFile() as f:
+            code = self.execute(argv, stdout=f, xenv=xenv, kind=kind)[0]
+            if code != 0:
+                self.bomb('"%s" failed with status %i' % (' '.join(argv), code),
+                          adtlog.AutopkgtestError)
+            f.seek(0)
+            return f.read()
+
     def bomb(self, m, _type=adtlog.TestbedFailure):
         adtlog.debug('%s %s' % (_type.__name__, m))
         #self.stop() # don't stop when bombing, so we can control it via no_clean_on_error
         raise _type(m)
 
 @contextlib.contextmanager
-def start_testbed(args, temp_dir, no_clean_on_error=False, host_distro=None):
+def start_testbed(args, temp_dir, no_clean_on_error=False, host_distro=None, cgroup_limits={}):
     '''This is a simple wrapper around adt_testbed that automates the
     initialization and cleanup.'''
     # Find the location of reprotest using setuptools and then get the
@@ -82,6 +101,7 @@ def start_testbed(args, temp_dir, no_clean_on_error=False, host_distro=None):
     # TODO: make the user configurable, like autopkgtest
     testbed = Testbed([server_path] + args[1:], temp_dir,
                       getpass.getuser(), host_distro=host_distro)
+    testbed.cgroup_limits = cgroup_limits
     testbed.start()
     testbed.open()
     should_clean = True
@@ -117,7 +137,7 @@ def coroutine(func):
 
 
 @contextlib.contextmanager
-def empty_or_temp_dir(empty_dir, name):
+def empty_or_temp_dir(empty_dir, name, temp_parent=None):
     if empty_dir:
         empty_dir = str(empty_dir)
         if not os.path.exists(empty_dir):
@@ -126,10 +146,48 @@ def empty_or_temp_dir(empty_dir, name):
             raise ValueError("%s must be empty: %s" % (name, empty_dir))
         yield empty_dir
     else:
-        with tempfile.TemporaryDirectory() as temp_dir:
+        with tempfile.TemporaryDirectory(dir=temp_parent) as temp_dir:
             yield temp_dir
 
 
+# each build has a copy of the source tree, the build products in it, a staged
+# copy of the source for the next build, and its artifacts
+SCRATCH_SIZE_FACTOR = 4
+
+def scratch_size_hint(source_root):
+    """Estimate the scratch space in bytes that a build of source_root needs."""
+    if os.path.isfile(source_root):
+        source_root = os.path.dirname(source_root) or "."
+    size = 0
+    for dirpath, _, filenames in os.walk(source_root):
+        for f in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, f)).st_blocks * 512
+            except OSError:
+                pass
+    return size * SCRATCH_SIZE_FACTOR
+
+
+def server_uses_size_hint(virtual_server_args):
+    """Whether the virtual server has options that use scratch_size_hint()."""
+    return any(a.split('=', 1)[0] in ('--tmpfs', '--tmpdir') for a in virtual_server_args[1:])
+
+
+def scratch_dir_for(scratch_dir, size):
+    """Return scratch_dir if it has size bytes free, otherwise None.
+
+    None makes tempfile use the default temporary directory.
+    """
+    if not scratch_dir:
+        return None
+    st = os.statvfs(scratch_dir)
+    if size > st.f_bavail * st.f_frsize:
+        logger.info("estimated scratch size of %s bytes exceeds the free space in %s, "
+                    "using the default temporary directory", size, scratch_dir)
+        return None
+    return scratch_dir
+
+
 def shell_copy_pattern(dst, src, globs):
     # assumes globs is already sanitized
     # mkdir -p dst if it doesn't already exist
@@ -154,6 +212,11 @@ class BuildContext(collections.namedtuple('_BuildContext',
     def testbed_dist(self):
         return os.path.join(self.testbed_root, 'artifacts-' + self.build_name, '')
 
+    @property
+    def testbed_src_staged(self):
+        # not specific to this build; see copydown_staged()
+        return os.path.join(self.testbed_root, 'source-staged', '')
+
     @property
     def local_dist(self):
         return os.path.join(self.local_dist_root, self.build_name)
@@ -186,11 +249,117 @@ class BuildContext(collections.namedtuple('_BuildContext',
         logger.info("copying %s over to virtual server's %s", self.local_src, self.testbed_src)
         testbed.command('copydown', (os.path.join(self.local_src, ''), self.testbed_src))
 
+    def copydown_staged(self, testbed):
+        """Start copying the source to a staging area in the testbed.
+
+        With a pipelined virtual server this runs concurrently with the current
+        build, and the next build just moves it into place with use_staged().
+        """
+        logger.info("prefetching %s to virtual server's %s", self.local_src, self.testbed_src_staged)
+        return testbed.command_async('copydown', (os.path.join(self.local_src, ''), self.testbed_src_staged))
+
+    def use_staged(self, testbed, staged):
+        testbed.command_wait(staged)
+        logger.info("moving prefetched source to virtual server's %s", self.testbed_src)
+        testbed.check_exec2(['mv', '-T', os.path.normpath(self.testbed_src_staged),
+                             os.path.normpath(self.testbed_src)])
+
     def copyup(self, testbed):
         logger.info("copying %s back from virtual server's %s", self.testbed_dist, self.local_dist)
         testbed.command('copyup', (self.testbed_dist, os.path.join(self.local_dist, '')))
 
-    def run_build(self, testbed, build, old_env, artifact_pattern, testbed_build_pre, no_clean_on_error):
+    def testbed_manifest(self, testbed):
+        """Return {path: (type, mode, symlink target, SHA-256)} of the dist on the testbed.
+
+        Names need not be UTF-8, so like compare.scan_tree() they are decoded
+        with surrogateescape, which os.fsencode() reverses.
+        """
+        entries = testbed.check_output(['sh', '-ec', 'cd "$1" && find . -mindepth 1 -printf "%y %m %l\\0%p\\0"',
+                                        'sh', self.testbed_dist]).split(b'\0')
+        entries = [os.fsdecode(e) for e in entries]
+        sums = os.fsdecode(testbed.check_output(['sh', '-ec', 'cd "$1" && find . -type f -exec sha256sum -- {} +',
+                                                 'sh', self.testbed_dist]))
+        digests = {}
+        for line in sums.split('\n'):
+            if not line:
+                continue
+            # sha256sum escapes names with a backslash or newline, see utils.sha256sums()
+            escaped = line.startswith('\\')
+            if escaped:
+                line = line[1:]
+            digest, path = line[:64], line[66:]
+            if escaped:
+                path = re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), path)
+            digests[path] = digest
+        manifest = {}
+        for info, path in zip(entries[0::2], entries[1::2]):
+            ftype, mode, target = info.split(' ', 2)
+            manifest[os.path.relpath(path)] = (ftype, mode, target, digests.get(path))
+        return manifest
+
+    def copyup_differing(self, testbed, reference, ref_manifest, manifest):
+        """Copy up only what differs from the dist of reference, a build on the
+        same testbed that was copied up in full.
+
+        The rest of the local dist are hard links to the files of reference.
+        manifest and ref_manifest are the testbed_manifest() of both.
+        """
+        differing = sorted(p for p in manifest.keys() | ref_manifest.keys()
+                           if manifest.get(p) != ref_manifest.get(p))
+        logger.info("copying %s of the files in virtual server's %s back to %s, the rest "
+                    "are the same as in %s", len(differing), self.testbed_dist,
+                    self.local_dist, reference.build_name)
+        shutil.copytree(reference.local_dist, self.local_dist, symlinks=True, copy_function=os.link)
+
+        def remove(path):
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.unlink(path)
+
+        to_copy = [p for p in differing if p in manifest and manifest[p][0] != 'd']
+        stage = os.path.join(self.local_dist_root, '.differing-' + self.build_name)
+        if to_copy:
+            testbed_list = os.path.join(self.testbed_root, 'differing-' + self.build_name + '.list')
+            testbed_stage = os.path.join(self.testbed_root, 'differing-' + self.build_name, '')
+            with tempfile.NamedTemporaryFile() as f:
+                f.write(b''.join(os.fsencode(p) + b'\0' for p in to_copy))
+                f.flush()
+                testbed.command('copydown', (f.name, testbed_list))
+            testbed.check_exec2(['sh', '-ec', 'cd "$1" && mkdir -p "$3" && '
+                                 'xargs -0 -r -a "$2" cp -a --parents -t "$3" --',
+                                 'sh', self.testbed_dist, testbed_list, testbed_stage])
+            testbed.command('copyup', (testbed_stage, os.path.join(stage, '')))
+            testbed.check_exec2(['rm', '-rf', testbed_list, testbed_stage])
+
+        for p in reversed(differing):
+            if p not in manifest:
+                remove(os.path.join(self.local_dist, p))
+        for p in differing:
+            if p not in manifest:
+                continue
+            path = os.path.join(self.local_dist, p)
+            if manifest[p][0] == 'd':
+                if not os.path.isdir(path) or os.path.islink(path):
+                    remove(path)
+                    os.makedirs(path)
+                os.chmod(path, int(manifest[p][1], 8))
+            else:
+                remove(path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(os.path.join(stage, p), path)
+        shutil.rmtree(stage, ignore_errors=True)
+
+    @property
+    def local_build_log(self):
+        return os.path.join(self.local_dist_root, self.build_name + '.build.log')
+
+    @property
+    def local_manifest(self):
+        return os.path.join(self.local_dist_root, self.build_name + '.manifest')
+
+    def run_build(self, testbed, build, old_env, artifact_pattern, testbed_build_pre, no_clean_on_error,
+                  store_compression='none', store_max_size=None):
         logger.info("starting build with source directory: %s, artifact pattern: %s",
             self.testbed_src, artifact_pattern)
         # we remove existing artifacts in case the build doesn't overwrite it
@@ -215,9 +384,18 @@ class BuildContext(collections.namedtuple('_BuildContext',
         else:
             build_argv = ['sh', '-ec', build_script]
 
-        testbed.check_exec2(build_argv,
-            xenv=['-i'] + ['%s=%s' % (k, v) for k, v in build.env.items()],
-            kind='build')
+        # stream stdout and stderr to ours, and both to the build log, keeping
+        # only the tail of that in memory for the error message
+        logger.info("saving build log to %s", self.local_build_log)
+        with stream.open_log(self.local_build_log, store_compression, store_max_size) as log:
+            merged = stream.Tee(log)
+            code = testbed.execute(build_argv,
+                xenv=['-i'] + ['%s=%s' % (k, v) for k, v in build.env.items()],
+                kind='build', tee=stream.Tee(sys.stdout.buffer, merged),
+                tee_err=stream.Tee(sys.stderr.buffer, merged))[0]
+        if code != 0:
+            testbed.bomb('"%s" failed with status %i, last lines of output:\n%s' %
+                (' '.join(build_argv), code, merged.tail()), adtlog.AutopkgtestError)
         logger.info("build successful, copying artifacts")
         dist_base = os.path.join(self.testbed_dist, VSRC_DIR)
         testbed.check_exec2(shell_copy_pattern(dist_base, self.testbed_src, artifact_pattern))
@@ -226,48 +404,233 @@ class BuildContext(collections.namedtuple('_BuildContext',
             r"""cd "{0}" && touch -d@0 . .. {1}""".format(dist_base, artifact_pattern)])
 
 
-def run_or_tee(progargs, filename, store_dir, *args, **kwargs):
+def shown_output(echo):
+    """Return the binary file for echo, see run_or_tee()."""
+    return sys.stdout.buffer if echo is True else echo
+
+@contextlib.contextmanager
+def tee_output(filename, store_dir, shown, compression='none', max_size=None, spool=None):
+    """Yield a stream.Tee to shown and to filename in store_dir, if given.
+
+    The saved copy is compressed with compression, and cut after max_size
+    bytes, see stream.open_log(). If spool, a file name, is given, the
+    output is also written there in full and uncompressed.
+    """
+    with contextlib.ExitStack() as stack:
+        outputs = [shown]
+        if store_dir:
+            outputs.append(stack.enter_context(
+                stream.open_log(os.path.join(store_dir, filename), compression, max_size)))
+        if spool:
+            outputs.append(stack.enter_context(stream.open_log(spool)))
+        yield stream.Tee(*outputs)
+
+def run_or_tee(progargs, filename, store_dir, *args, echo=True, run=subprocess.run,
+               compression='none', max_size=None, spool=None, **kwargs):
+    """Run progargs, saving its output as filename in store_dir, if given.
+
+    If echo is True, the output is shown; otherwise it is a binary file that
+    the output is written to instead, e.g. to show it later. run is called
+    like subprocess.run to run progargs. See tee_output() for the other
+    arguments.
+    """
+    shown = shown_output(echo)
+    (sys.stdout if echo is True else shown).flush()
+    if not store_dir and not spool:
+        return run(progargs, *args, stdout=None if echo is True else shown, **kwargs)
+
+    with tee_output(filename, store_dir, shown, compression, max_size, spool) as tee:
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'rb', buffering=0) as output:
+            pump = threading.Thread(target=tee.pump, args=(output,))
+            pump.start()
+            try:
+                r = run(progargs, *args, stdout=write_fd, **kwargs)
+            finally:
+                # progargs has exited, so this is the last writer
+                os.close(write_fd)
+                pump.join()
+    return r
+
+def write_or_tee(output, filename, store_dir, echo=True, compression='none', max_size=None):
+    """Like run_or_tee(), for output that was produced in-process."""
     if store_dir:
-        tee = subprocess.Popen(['tee', filename], stdin=subprocess.PIPE, cwd=store_dir)
-        r = subprocess.run(progargs, *args, stdout=tee.stdin, **kwargs)
-        tee.communicate()
-        return r
-    else:
-        return subprocess.run(progargs, *args, **kwargs)
+        with stream.open_log(os.path.join(store_dir, filename), compression, max_size) as f:
+            f.write(output)
+    shown = shown_output(echo)
+    shown.write(output)
+    (sys.stdout if echo is True else shown).flush()
+
+def run_compare(dist_0, dist_1, filename, store_dir, echo=True, store_opts={}):
+    """Like run_or_tee() for compare.compare_trees(), which runs in-process."""
+    differences = compare.compare_trees(dist_0, dist_1, len(os.sched_getaffinity(0)))
+    report = compare.format_differences(differences, dist_0, dist_1).encode()
+    write_or_tee(report, filename, store_dir, echo, **store_opts)
+    return subprocess.CompletedProcess(['compare', dist_0, dist_1], 1 if differences else 0)
+
+def diffoscope_ignores_metadata(diffoscope_args):
+    """Whether diffoscope ignores file metadata like compare.compare_trees().
+
+    That is with --exclude-directory-metadata yes or recursive, given as a
+    separate argument, after "=", or implied by the bare option; its default
+    "auto" means no when comparing directories.
+    """
+    choices = ('auto', 'yes', 'no', 'recursive')
+    ignores = False
+    for i, a in enumerate(diffoscope_args):
+        if a == '--exclude-directory-metadata':
+            # the value is optional
+            value = diffoscope_args[i + 1] if i + 1 < len(diffoscope_args) else 'yes'
+            if value not in choices:
+                value = 'yes'
+        elif a.startswith('--exclude-directory-metadata='):
+            value = a.split('=', 1)[1]
+        elif a == '--no-exclude-directory-metadata':
+            value = 'no'
+        else:
+            continue
+        ignores = value in ('yes', 'recursive')
+    return ignores
+
+def run_diffoscope(dist_0, dist_1, diffoscope_args, store_dir, echo=True, cache=None,
+                   server=None, store_opts={}):
+    """Like run_or_tee() for diffoscope, reusing its results from cache.
 
-def run_diff(dist_0, dist_1, diffoscope_args, store_dir):
+    If server, a diffoscope_server.DiffoscopeServer, is given, diffoscope is
+    run through that. store_opts are passed on to run_or_tee().
+    """
     name = os.path.basename(dist_1)
+    diffprogram = ([a.format(name, dist_1) for a in diffoscope_args]
+        + [dist_0, dist_1])
+    output = '%s.diffoscope.out' % name
+    run = server.run if server else subprocess.run
+    # the output files of arguments like --html {0}.html are not cached
+    if cache is None or any('{' in a for a in diffoscope_args):
+        logger.info("Running diffoscope: %r", diffprogram)
+        return run_or_tee(diffprogram, output, store_dir, echo=echo, run=run, **store_opts)
+
+    key = cache.key(dist_0, dist_1, diffoscope_args,
+                    not diffoscope_ignores_metadata(diffoscope_args),
+                    len(os.sched_getaffinity(0)), store_opts.get('max_size'))
+    cached = cache.get(key, dist_0, dist_1)
+    if cached:
+        logger.info("Reusing the diffoscope output cached as %s", key)
+        retcode, lines = cached
+        with tee_output(output, store_dir, shown_output(echo), **store_opts) as tee:
+            for line in lines:
+                tee.write(line)
+        return subprocess.CompletedProcess(diffprogram, retcode)
+
+    logger.info("Running diffoscope: %r", diffprogram)
+    # the output is spooled to a file to be cached, rather than kept in memory;
+    # that is the full output, to show it in full again when it is reused
+    fd, spool = tempfile.mkstemp(dir=cache.cache_dir, prefix='.tmp.')
+    os.close(fd)
+    try:
+        r = run_or_tee(diffprogram, output, store_dir, echo=echo, run=run, spool=spool,
+                       **store_opts)
+        if r.returncode in (0, 1):
+            cache.put(key, dist_0, dist_1, r.returncode, spool)
+    finally:
+        os.unlink(spool)
+    return r
+
+def run_diff(dist_0, dist_1, diffoscope_args, store_dir, cache=None, server=None,
+             store_opts={}, results=None, summary=False):
+    return diff_dists(dist_0, dist_1, diffoscope_args, store_dir, cache=cache, server=server,
+                      store_opts=store_opts, results=results, summary=summary).returncode
+
+def diff_dists(dist_0, dist_1, diffoscope_args, store_dir, echo=True, cache=None,
+               server=None, store_opts={}, results=None, summary=False):
+    name = os.path.basename(dist_1)
+    start = time.monotonic()
     if diffoscope_args is None: # don't run diffoscope
-        diffprogram = ['diff', '-ru', dist_0, dist_1]
-        logger.info("Running diff: %r", diffprogram)
-        output = '%s.diff' % name
+        logger.info("Comparing: %s, %s", dist_0, dist_1)
+        r = run_compare(dist_0, dist_1, '%s.diff' % name, store_dir, echo, store_opts)
     else:
-        diffprogram = ([a.format(name, dist_1) for a in diffoscope_args]
-            + [dist_0, dist_1])
-        logger.info("Running diffoscope: %r", diffprogram)
-        output = '%s.diffoscope.out' % name
+        r = None
+        if summary:
+            # quickly find out which files and archive members differ, then
+            # diffoscope only needs to run if there are any
+            r = run_compare(dist_0, dist_1, '%s.summary' % name, store_dir, echo, store_opts)
+            if r.returncode == 0 and diffoscope_ignores_metadata(diffoscope_args):
+                logger.info("Not running diffoscope, all files are identical")
+            else:
+                r = None
+        if r is None:
+            r = run_diffoscope(dist_0, dist_1, diffoscope_args, store_dir, echo, cache, server,
+                               store_opts)
 
-    retcode = run_or_tee(diffprogram, output, store_dir).returncode
-    if retcode == 0:
+    if r.returncode == 0:
         logger.info("No differences between %s, %s", dist_0, dist_1)
         if store_dir:
             shutil.rmtree(dist_1)
             os.symlink(os.path.basename(dist_0), dist_1)
-    return retcode
+    if results:
+        results.add_diff(name, os.path.basename(dist_0), r.returncode,
+                         time.monotonic() - start, store_dir)
+    return r
 
 
 class TestbedArgs(collections.namedtuple('_TestbedArgs',
-    'virtual_server_args testbed_pre testbed_init testbed_build_pre host_distro')):
+    'virtual_server_args testbed_pre testbed_init testbed_build_pre host_distro build_jobs '
+    'cpu_budget memory_budget')):
     @classmethod
-    def of(cls, virtual_server_args=[], testbed_pre=None, testbed_init=None, testbed_build_pre=None, host_distro=None):
-        return cls(virtual_server_args, testbed_pre, testbed_init, testbed_build_pre, host_distro)
+    def of(cls, virtual_server_args=[], testbed_pre=None, testbed_init=None, testbed_build_pre=None, host_distro=None,
+           build_jobs=1, cpu_budget=None, memory_budget=None):
+        return cls(virtual_server_args, testbed_pre, testbed_init, testbed_build_pre, host_distro, build_jobs,
+                   cpu_budget, memory_budget)
+
+    def split_budget(self, jobs):
+        """Split the CPU and memory budget into jobs disjoint parts.
+
+        Returns a list of TestbedArgs, one for each of the concurrent testbeds.
+        """
+        cpus = self.cpu_budget
+        if cpus and len(cpus) < jobs:
+            raise ValueError("--cpu-budget has fewer CPUs than build jobs: %s" %
+                             VirtSubproc.format_cpu_list(cpus))
+        return [self._replace(
+            cpu_budget=cpus and cpus[i * len(cpus) // jobs:(i + 1) * len(cpus) // jobs],
+            memory_budget=self.memory_budget and self.memory_budget // jobs)
+            for i in range(jobs)]
+
+    def apply_budget(self):
+        """Confine ourselves, and so the testbed we start, to the budget.
+
+        Returns the cgroup limits for the commands that the testbed runs on the
+        host; there is a warning for each one that cannot be applied. Virtual
+        servers that run them elsewhere get the budget from
+        $REPROTEST_TESTBED_CPUS and $REPROTEST_TESTBED_MEMORY instead.
+        """
+        limits = self.cgroup_limits()
+        if self.cpu_budget:
+            os.sched_setaffinity(0, self.cpu_budget)
+            os.environ["REPROTEST_TESTBED_CPUS"] = limits["cpuset.cpus"]
+        if self.memory_budget:
+            os.environ["REPROTEST_TESTBED_MEMORY"] = limits["memory.max"]
+        return limits
+
+    def cgroup_limits(self):
+        """Return the cgroup limits that apply_budget() sets up."""
+        limits = {}
+        if self.cpu_budget:
+            limits["cpuset.cpus"] = VirtSubproc.format_cpu_list(self.cpu_budget)
+        if self.memory_budget:
+            limits["memory.max"] = str(self.memory_budget)
+        return limits
 
 
 class TestArgs(collections.namedtuple('_Test',
-    'build_command source_root artifact_pattern result_dir source_pattern no_clean_on_error diffoscope_args')):
+    'build_command source_root artifact_pattern result_dir source_pattern no_clean_on_error diffoscope_args '
+    'store_compression scratch_dir store_objects diff_jobs diff_cache diffoscope_server '
+    'store_max_size results compare_in_testbed diff_summary scratch_size')):
     @classmethod
     def of(cls, build_command, source_root, artifact_pattern, result_dir=None,
-                source_pattern=None, no_clean_on_error=False, diffoscope_args=['diffoscope']):
+                source_pattern=None, no_clean_on_error=False, diffoscope_args=['diffoscope'],
+                store_compression='none', scratch_dir=None, store_objects=None, diff_jobs=1,
+                diff_cache=None, diffoscope_server=None, store_max_size=None, results=None,
+                compare_in_testbed=False, diff_summary=False):
         artifact_pattern = shell_syn.sanitize_globs(artifact_pattern)
         logger.debug("artifact_pattern sanitized to: %s", artifact_pattern)
 
@@ -275,7 +638,33 @@ class TestArgs(collections.namedtuple('_Test',
             source_pattern = shell_syn.sanitize_globs(source_pattern)
             logger.debug("source_pattern sanitized to: %s", source_pattern)
         return cls(build_command, source_root, artifact_pattern, result_dir,
-                   source_pattern, no_clean_on_error, diffoscope_args)
+                   source_pattern, no_clean_on_error, diffoscope_args, store_compression,
+                   scratch_dir, store_objects, diff_jobs, diff_cache, diffoscope_server,
+                   store_max_size, results, compare_in_testbed, diff_summary, None)
+
+    def store_opts(self):
+        """Return the keyword arguments of run_or_tee() for saving output."""
+        return {'compression': self.store_compression, 'max_size': self.store_max_size}
+
+    def with_scratch_size(self, testbed_args):
+        """Return these arguments with the scratch_size_hint() of the source.
+
+        That walks the whole source, so it is only done once, and only if
+        --scratch-dir or the virtual server use it.
+        """
+        if self.scratch_size is not None or not (
+                self.scratch_dir or server_uses_size_hint(testbed_args.virtual_server_args)):
+            return self
+        return self._replace(scratch_size=scratch_size_hint(self.source_root))
+
+    def host_scratch_dir(self):
+        """Return the directory for host-side temporary directories, or None.
+
+        Call this on the result of with_scratch_size().
+        """
+        if not self.scratch_dir:
+            return None
+        return scratch_dir_for(self.scratch_dir, self.scratch_size or 0)
 
     @coroutine
     def corun_builds(self, testbed_args):
@@ -285,9 +674,14 @@ class TestArgs(collections.namedtuple('_Test',
         .>>> for name, var in variations:
         .>>>     local_dist = proc.send((name, var))
         .>>>     ...
+
+        A third item False, as in (name, var, False), says that no other build
+        follows, so that the source is not copied ahead for one.
         """
-        build_command, source_root, artifact_pattern, result_dir, source_pattern, no_clean_on_error, diffoscope_args = self
-        virtual_server_args, testbed_pre, testbed_init, testbed_build_pre, host_distro = testbed_args
+        build_command, source_root, artifact_pattern, result_dir, source_pattern, no_clean_on_error, diffoscope_args, \
+            store_compression, scratch_dir, store_objects, _, _, _, store_max_size, results, \
+            compare_in_testbed, _, _ = self
+        virtual_server_args, testbed_pre, testbed_init, testbed_build_pre, host_distro, _, _, _ = testbed_args
 
         if not source_root:
             raise ValueError("invalid source root: %s" % source_root)
@@ -297,8 +691,16 @@ class TestArgs(collections.namedtuple('_Test',
 
         logger.debug("virtual_server_args: %r", virtual_server_args)
 
+        # let virtual servers decide whether the builds fit into RAM-backed
+        # scratch space, see e.g. autopkgtest-virt-null --tmpfs
+        size_hint = self.with_scratch_size(testbed_args).scratch_size
+        if size_hint is not None:
+            os.environ["REPROTEST_SCRATCH_SIZE_HINT"] = str(size_hint)
+        else:
+            os.environ.pop("REPROTEST_SCRATCH_SIZE_HINT", None)
+
         # TODO: if no_clean_on_error then this shouldn't be rm'd
-        with tempfile.TemporaryDirectory() as temp_dir:
+        with tempfile.TemporaryDirectory(dir=scratch_dir_for(scratch_dir, size_hint)) as temp_dir:
             if testbed_pre or source_pattern:
                 new_source_root = os.path.join(temp_dir, "testbed_pre")
                 subprocess.check_call(shell_copy_pattern(new_source_root, source_root, source_pattern or "."))
@@ -310,31 +712,129 @@ class TestArgs(collections.namedtuple('_Test',
             # TODO: an alternative strategy is to run the testbed many times, one for each build
             # not sure if it's worth implementing at this stage, but perhaps in the future.
             with start_testbed(virtual_server_args, temp_dir, no_clean_on_error,
-                               host_distro=host_distro) as testbed:
+                               host_distro=host_distro,
+                               cgroup_limits=testbed_args.apply_budget()) as testbed:
                 if testbed_init:
                     testbed.check_exec2(["sh", "-ec", testbed_init])
 
                 name_variation = yield
                 names_seen = set()
-                while name_variation:
-                    name, var = name_variation
-                    if name in names_seen:
-                        raise ValueError("already built '%s'" % name)
-                    names_seen.add(name)
-
-                    bctx = BuildContext(testbed.scratch, result_dir, source_root, name, var)
-
-                    build = bctx.make_build_commands(build_command, os.environ)
-                    bctx.copydown(testbed)
-                    bctx.run_build(testbed, build, os.environ, artifact_pattern, testbed_build_pre, no_clean_on_error)
-                    bctx.copyup(testbed)
+                staged = None
+                # with compare_in_testbed, the first build is copied up in
+                # full and the others only where they differ from it
+                reference = None
+                objects = store_objects and store.ObjectStore(store_objects)
+                try:
+                    while name_variation:
+                        name, var = name_variation[:2]
+                        more = name_variation[2] if len(name_variation) > 2 else True
+                        if name in names_seen:
+                            raise ValueError("already built '%s'" % name)
+                        names_seen.add(name)
+
+                        bctx = BuildContext(testbed.scratch, result_dir, source_root, name, var)
+
+                        build = bctx.make_build_commands(build_command, os.environ)
+                        if staged:
+                            bctx.use_staged(testbed, staged)
+                        else:
+                            bctx.copydown(testbed)
+                        # overlap copying the source for the next build with this one
+                        staged = bctx.copydown_staged(testbed) if testbed.pipelined and more else None
+                        start = time.monotonic()
+                        bctx.run_build(testbed, build, os.environ, artifact_pattern, testbed_build_pre, no_clean_on_error,
+                                       store_compression, store_max_size)
+                        if not compare_in_testbed:
+                            bctx.copyup(testbed)
+                        elif reference:
+                            bctx.copyup_differing(testbed, reference[0], reference[1],
+                                                  bctx.testbed_manifest(testbed))
+                        else:
+                            bctx.copyup(testbed)
+                            reference = (bctx, bctx.testbed_manifest(testbed))
+                        duration = time.monotonic() - start
+                        if objects:
+                            objects.add_tree(bctx.local_dist, bctx.local_manifest)
+                        if results:
+                            results.add_build(name, var, duration, bctx.local_dist,
+                                              objects and bctx.local_manifest,
+                                              len(os.sched_getaffinity(0)))
+
+                        name_variation = yield bctx.local_dist
+                except GeneratorExit:
+                    pass
+                if staged:
+                    # nothing used it, but let it finish before the testbed is stopped
+                    testbed.command_wait(staged)
+
+    def run_builds(self, testbed_args, name_variations):
+        """Run the given builds, yielding (name, local_dist) as each one finishes.
+
+        With testbed_args.build_jobs > 1, the builds are spread over that many
+        worker processes, each one with its own testbed (e.g. its own schroot
+        session), that run in parallel.
+        """
+        jobs = min(testbed_args.build_jobs, len(name_variations))
+        if jobs <= 1:
+            proc = self.corun_builds(testbed_args)
+            for i, (name, var) in enumerate(name_variations):
+                yield name, proc.send((name, var, i + 1 < len(name_variations)))
+            proc.close()
+            return
+
+        # set up the cgroups for the commands of all testbeds, see apply_budget()
+        limits = testbed_args.cgroup_limits()
+        if limits and adt_testbed.host_server(testbed_args.virtual_server_args):
+            adt_testbed.cgroup_prepare(limits)
+        ctx = multiprocessing.get_context('fork')
+        results = ctx.Queue()
+        workers = [ctx.Process(target=self._build_worker,
+                               args=(worker_args, name_variations[i::jobs], results))
+                   for i, worker_args in enumerate(testbed_args.split_budget(jobs))]
+        for w in workers:
+            w.start()
+        finished = False
+        try:
+            for _ in name_variations:
+                while True:
+                    try:
+                        name, local_dist, error = results.get(timeout=1)
+                        break
+                    except queue.Empty:
+                        if not any(w.is_alive() for w in workers) and results.empty():
+                            raise RuntimeError("build workers exited without finishing all builds")
+                if error:
+                    raise RuntimeError("build %s failed:\n%s" % (name, error))
+                yield name, local_dist
+            finished = True
+        finally:
+            # on errors, interrupt the remaining workers so they clean up their
+            # testbeds; otherwise they are just stopping them
+            for w in workers:
+                if not finished and w.is_alive():
+                    os.kill(w.pid, signal.SIGINT)
+                w.join()
+
+    def _build_worker(self, testbed_args, name_variations, results):
+        name = None
+        try:
+            proc = self.corun_builds(testbed_args)
+            for i, (name, var) in enumerate(name_variations):
+                results.put((name, proc.send((name, var, i + 1 < len(name_variations))), None))
+            proc.close()
+        except BaseException:
+            results.put((name, None, traceback.format_exc()))
 
-                    name_variation = yield bctx.local_dist
+    def check_reproducible(self, proc, dist_control, name, var, more=True):
+        """Build experiment name and diff it against the control.
 
-    def check_reproducible(self, proc, dist_control, name, var):
-        dist_test = proc.send(("experiment-%s" % name, var))
+        Pass more=False if no build follows, see corun_builds().
+        """
+        dist_test = proc.send(("experiment-%s" % name, var, more))
         # TODO: handle exit codes > 1 correctly, raise a CalledProcessError
-        retcode = run_diff(dist_control, dist_test, self.diffoscope_args, self.result_dir)
+        retcode = run_diff(dist_control, dist_test, self.diffoscope_args, self.result_dir,
+                           self.diff_cache, self.diffoscope_server, self.store_opts(),
+                           self.results, self.diff_summary)
         if retcode == 0:
             return True
         elif retcode == 1:
@@ -347,24 +847,77 @@ class TestArgs(collections.namedtuple('_Test',
         print("Reproduction successful")
         print("=======================")
         print("No differences in %s" % self.artifact_pattern, flush=True)
-        run_or_tee(['sh', '-ec', 'find %s -type f -exec sha256sum "{}" \;' % self.artifact_pattern],
-            'SHA256SUMS', self.result_dir,
-            cwd=os.path.join(dist_control, VSRC_DIR))
+        cwd = os.path.join(dist_control, VSRC_DIR)
+        # the shell expands the pattern; hashing is done here, not by one
+        # sha256sum process per file
+        paths = subprocess.check_output(
+            ['sh', '-ec', 'find %s -type f -print0' % self.artifact_pattern], cwd=cwd)
+        paths = [os.fsdecode(p) for p in paths.split(b'\0') if p]
+        sums = sha256sums(paths, cwd, len(os.sched_getaffinity(0)))
+        write_or_tee(os.fsencode(sums), 'SHA256SUMS', self.result_dir)
+
+
+def run_diffs_parallel(builds, bnames, diffoscope_args, store_dir, jobs, cache=None,
+                       server=None, store_opts={}, results=None, summary=False):
+    """Diff each experiment against the control as soon as both are built.
+
+    builds yields (name, local_dist) in any order; up to jobs diffs run at
+    the same time. Their output is spooled to temporary files, in store_dir
+    if given, and shown in the order of bnames once each one has finished.
+    Returns the dists and an OrderedDict of the diffs' exit codes.
+    """
+    dists = {}
+    diffs = {}
+    with contextlib.ExitStack() as spools, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for bname, dist in builds:
+            dists[bname] = dist
+            if bnames[0] not in dists:
+                continue
+            for b in bnames[1:]:
+                if b in dists and b not in diffs:
+                    spool = spools.enter_context(tempfile.TemporaryFile(dir=store_dir))
+                    diffs[b] = (spool, pool.submit(
+                        diff_dists, dists[bnames[0]], dists[b], diffoscope_args, store_dir,
+                        echo=spool, cache=cache, server=server, store_opts=store_opts,
+                        results=results, summary=summary))
+        retcodes = collections.OrderedDict()
+        for bname in bnames[1:]:
+            spool, diff = diffs[bname]
+            r = diff.result()
+            spool.seek(0)
+            sys.stdout.flush()
+            shutil.copyfileobj(spool, sys.stdout.buffer)
+            sys.stdout.flush()
+            retcodes[bname] = r.returncode
+    return dists, retcodes
 
 
 def check(test_args, testbed_args, build_variations=Variations.of(VariationSpec.default())):
     # default argument [] is safe here because we never mutate it.
-    _, _, artifact_pattern, store_dir, _, _, diffoscope_args = test_args
-    with empty_or_temp_dir(store_dir, "store_dir") as result_dir:
+    store_dir, diffoscope_args = test_args.result_dir, test_args.diffoscope_args
+    test_args = test_args.with_scratch_size(testbed_args)
+    with empty_or_temp_dir(store_dir, "store_dir", test_args.host_scratch_dir()) as result_dir:
         assert store_dir == result_dir or store_dir is None
-        proc = test_args._replace(result_dir=result_dir).corun_builds(testbed_args)
-
         bnames = ["control"] + ["experiment-%s" % i for i in range(1, len(build_variations))]
-        local_dists = [proc.send(nv) for nv in zip(bnames, build_variations)]
-
-        retcodes = collections.OrderedDict(
-            (bname, run_diff(local_dists[0], dist, diffoscope_args, store_dir))
-            for bname, dist in zip(bnames, local_dists[1:]))
+        builds = test_args._replace(result_dir=result_dir).run_builds(
+            testbed_args, list(zip(bnames, build_variations)))
+        if test_args.diff_jobs <= 1:
+            dists = dict(builds)
+            local_dists = [dists[bname] for bname in bnames]
+            retcodes = collections.OrderedDict(
+                (bname, run_diff(local_dists[0], dist, diffoscope_args, store_dir,
+                                 test_args.diff_cache, test_args.diffoscope_server,
+                                 test_args.store_opts(), test_args.results,
+                                 test_args.diff_summary))
+                for bname, dist in zip(bnames, local_dists[1:]))
+        else:
+            dists, retcodes = run_diffs_parallel(builds, bnames, diffoscope_args, store_dir,
+                                                 test_args.diff_jobs, test_args.diff_cache,
+                                                 test_args.diffoscope_server,
+                                                 test_args.store_opts(), test_args.results,
+                                                 test_args.diff_summary)
+            local_dists = [dists[bname] for bname in bnames]
 
         retcode = max(retcodes.values())
         if retcode == 0:
@@ -385,20 +938,25 @@ def check(test_args, testbed_args, build_variations=Variations.of(VariationSpec.
 
 def check_auto(test_args, testbed_args, build_variations=Variations.of(VariationSpec.default())):
     # default argument [] is safe here because we never mutate it.
-    _, _, _, store_dir, _, _, diffoscope_args = test_args
-    with empty_or_temp_dir(store_dir, "store_dir") as result_dir:
+    store_dir = test_args.result_dir
+    test_args = test_args.with_scratch_size(testbed_args)
+    with empty_or_temp_dir(store_dir, "store_dir", test_args.host_scratch_dir()) as result_dir:
         assert store_dir == result_dir or store_dir is None
         proc = test_args._replace(result_dir=result_dir).corun_builds(testbed_args)
 
         var_x0, var_x1 = build_variations
         dist_x0 = proc.send(("control", var_x0))
-        is_reproducible = lambda name, var: test_args.check_reproducible(proc, dist_x0, name, var)
+        is_reproducible = lambda name, var, more=True: test_args.check_reproducible(
+            proc, dist_x0, name, var, more)
 
         if not is_reproducible("0", var_x0):
             print("Not reproducible, even when fixing as much as reprotest knows how to. :(")
             return False
 
-        if is_reproducible("1", var_x1):
+        varnames = [v for v in VariationSpec.all_names() if v in var_x1.spec]
+        random.shuffle(varnames)
+
+        if is_reproducible("1", var_x1, bool(varnames)):
             print("Reproducible, even when varying as much as reprotest knows how to! :)")
             test_args.output_reproducible_hashes(dist_x0)
             return True
@@ -406,11 +964,9 @@ def check_auto(test_args, testbed_args, build_variations=Variations.of(Variation
         var_cur = var_x0
         unreproducibles = []
 
-        varnames = [v for v in VariationSpec.all_names() if v in var_x1.spec]
-        random.shuffle(varnames)
-        for v in varnames:
+        for i, v in enumerate(varnames):
             var_test = var_cur.replace.spec._replace(**{v: var_x1.spec[v]})
-            if is_reproducible(v, var_test):
+            if is_reproducible(v, var_test, i + 1 < len(varnames)):
                 # vary it for the next test as well, it's OK to vary it
                 var_cur = var_test
             else:
@@ -425,14 +981,16 @@ def check_auto(test_args, testbed_args, build_variations=Variations.of(Variation
 
 def check_env(test_args, testbed_args, build_variations=Variations.of(VariationSpec.default())):
     # default argument [] is safe here because we never mutate it.
-    _, _, artifact_pattern, store_dir, _, _, diffoscope_args = test_args
-    with empty_or_temp_dir(store_dir, "store_dir") as result_dir:
+    store_dir = test_args.result_dir
+    test_args = test_args.with_scratch_size(testbed_args)
+    with empty_or_temp_dir(store_dir, "store_dir", test_args.host_scratch_dir()) as result_dir:
         assert store_dir == result_dir or store_dir is None
         proc = test_args._replace(result_dir=result_dir).corun_builds(testbed_args)
 
         var_x0, var_x1 = build_variations
         dist_x0 = proc.send(("control", var_x0))
-        is_reproducible = lambda name, var: test_args.check_reproducible(proc, dist_x0, name, var)
+        is_reproducible = lambda name, var, more=True: test_args.check_reproducible(
+            proc, dist_x0, name, var, more)
 
         orig_variations = var_x1.spec.variations()
         only_varying_env = (len(orig_variations) == 0 or
@@ -453,7 +1011,7 @@ def check_env(test_args, testbed_args, build_variations=Variations.of(VariationS
 
         # Test non-whitelist
         var_x2 = var_x1.replace.spec.environment.extend_variables(*non_whitelist)
-        if not is_reproducible("non-whitelist", var_x2):
+        if not is_reproducible("non-whitelist", var_x2, False):
             print("Unreproducible when varying unknown envvars: ", ", ".join(sorted(non_whitelist_names)))
             print("Please file a bug to reprotest to add these to the whitelist or blacklist, to be decided.")
             print("If blacklist, then you should also make your program reproducible when varying them.")
@@ -560,7 +1118,33 @@ def cli_parser():
     group1.add_argument('--store-dir', default=None, metavar='DIRECTORY',
         help='Save the artifacts in this directory, which must be empty or '
         'non-existent. Otherwise, the artifacts will be deleted and you only '
-        'see their hashes (if reproducible) or the diff output (if not).')
+        'see their hashes (if reproducible) or the diff output (if not). '
+        'The output of each build is also saved here, as <build>.build.log. '
+        'Identical files are stored only once, see --store-objects.')
+    group1.add_argument('--store-objects', default=None, metavar='DIRECTORY',
+        help='Keep each distinct artifact file once in this directory, named '
+        'after its SHA-256, and make the artifacts in --store-dir hard links '
+        '(or reflinks, if e.g. their permissions differ) to these. A list of '
+        'the artifacts of each build is saved as <build>.manifest. Give the '
+        'same directory to several runs to share files between them; it must '
+        'be on the same file system as --store-dir, otherwise nothing is '
+        'deduplicated. Only used with --store-dir. Default: the "objects" '
+        'directory in --store-dir')
+    group1.add_argument('--store-compression', default='none',
+        choices=list(stream.COMPRESSIONS.keys()),
+        help='Compress the build logs and diff outputs saved in --store-dir '
+        'with this. Default: %(default)s')
+    group1.add_argument('--store-max-size', default=None, metavar='SIZE',
+        type=VirtSubproc.parse_size,
+        help='Save at most this much of each build log and diff output in '
+        '--store-dir, in bytes or with a K, M or G suffix, and note how much '
+        'was cut. What is shown on the terminal is not affected. Default: no '
+        'limit')
+    group1.add_argument('--results-file', default=None, metavar='FILE',
+        help='Write the results as JSON to FILE: the variations, duration and '
+        'artifacts (with their sizes and SHA-256) of each build, the exit '
+        'code, duration and saved reports of each diff, and the verdict. It '
+        'is updated as each build and diff finishes.')
     group1.add_argument('--variations', default="+all",
         help='Build variations to test as a comma-separated list of variation '
         'names. Default is "+all", equivalent to "%s", testing all available '
@@ -602,10 +1186,33 @@ def cli_parser():
     group2.add_argument('--diffoscope', default='diffoscope', metavar='PATH',
         help='Path to diffoscope(1). Default: %(default)s')
     group2.add_argument('--no-diffoscope', action='store_true', default=False,
-        help='Don\'t run diffoscope; instead run diff(1). Useful if you '
+        help='Don\'t run diffoscope; instead only list the files that differ, '
+        'like diff -rq. Useful if you '
         'don\'t want to install diffoscope and/or just want a quick answer '
         'on whether the reproduction was successful or not, without spending '
         'time to compute all the detailed differences.')
+    group2.add_argument('--diffoscope-server', action='store_true', default=False,
+        help='Run diffoscope through its Python API, in forks of a process '
+        'that imported it once, instead of starting it anew for every '
+        'comparison. The diffoscope module must be importable by the Python '
+        'running reprotest; --diffoscope is then ignored.')
+    group2.add_argument('--diff-cache', default=None, metavar='DIRECTORY',
+        help='Cache the output of diffoscope in this directory, and reuse it '
+        'when the same files are compared with the same --diffoscope-arg '
+        'again, e.g. in later runs. Not used with --diffoscope-arg values '
+        'that name output files, like --html {0}.html.')
+    group2.add_argument('--diff-cache-size', default=1 << 30, metavar='SIZE',
+        type=VirtSubproc.parse_size,
+        help='Remove the least recently used entries of --diff-cache when it '
+        'grows beyond this size, in bytes or with a K, M or G suffix. '
+        'Default: 1G')
+    group2.add_argument('--diff-summary', action='store_true', default=False,
+        help='Before running diffoscope, compare the outputs like '
+        '--no-diffoscope does, also listing the differing members of ar, tar '
+        'and zip archives, and save that as <experiment>.summary. diffoscope '
+        'is then not run if nothing differs and --diffoscope-arg has '
+        '--exclude-directory-metadata. This reads the outputs once more when '
+        'they do differ, so it only saves time for mostly reproducible builds.')
 
     group3 = parser.add_argument_group('advanced options')
     group3.add_argument('--testbed-pre', default=None, metavar='COMMANDS',
@@ -625,6 +1232,38 @@ def cli_parser():
         'that transforms the _ variable, which is of type reprotest.presets.ReprotestPreset. '
         'See that class\'s documentation for ways you can write this '
         'expression. Default: %(default)s')
+    group3.add_argument('--build-jobs', default=1, type=int, metavar='NUM',
+        help='Run up to this many builds in parallel, each in its own '
+        'instance of the virtual server. Only used when no --auto-build or '
+        '--env-build is given. Default: %(default)s')
+    group3.add_argument('--scratch-dir', default=None, metavar='DIRECTORY',
+        help='Create the temporary directories on the host in this directory, '
+        'e.g. a RAM-backed one like /dev/shm, unless the builds are estimated '
+        'to need more space than is free there. See also the --tmpdir and '
+        '--tmpfs options of the null virtual server.')
+    group3.add_argument('--cpu-budget', default=None, metavar='CPUS',
+        type=VirtSubproc.parse_cpu_list,
+        help='Host CPUs to run the builds on, as a list like 0-7,16-23. It is '
+        'split into disjoint sets for the testbeds of --build-jobs, and the '
+        'num_cpus variation picks CPUs from these. Default: all CPUs')
+    group3.add_argument('--memory-budget', default=None, metavar='SIZE',
+        type=VirtSubproc.parse_size,
+        help='Memory for the builds, in bytes or with a K, M or G suffix. It '
+        'is split evenly between the testbeds of --build-jobs. For the null, '
+        'chroot, schroot and unshare virtual servers, this needs the cgroup '
+        'v2 memory controller to be delegated to a cgroup of reprotest\'s own, '
+        'e.g. with systemd-run --user --scope -p Delegate=yes. Default: no limit')
+    group3.add_argument('--compare-in-testbed', action='store_true', default=False,
+        help='Hash the artifacts of each build in the virtual server, and only '
+        'copy back the ones that differ from those of the first build on the '
+        'same virtual server, which is copied back in full. The other files '
+        'are hard links to those of the first build. Timestamps are not '
+        'compared. Useful for remote or slow to copy from virtual servers.')
+    group3.add_argument('--diff-jobs', default=1, type=int, metavar='NUM',
+        help='Run up to this many diffs of experiments against the control '
+        'build in parallel, starting each as soon as its builds are done. '
+        'Their output is shown once they finish, in the usual order. Only '
+        'used when no --auto-build or --env-build is given. Default: %(default)s')
     group3.add_argument('--no-clean-on-error', action='store_true', default=False,
         help='Don\'t clean the virtual_server if there was an error. '
         'Useful for debugging but will leave cruft on your system depending on '
@@ -808,6 +1447,10 @@ def run(argv, dry_run=None):
     # Remaining args
     host_distro = parsed_args.host_distro
     store_dir = parsed_args.store_dir
+    # the artifacts are only kept with --store-dir, so only dedupe them then
+    if parsed_args.store_objects and not store_dir:
+        logger.warning("Ignoring --store-objects, as it needs --store-dir")
+    store_objects = store_dir and (parsed_args.store_objects or os.path.join(store_dir, 'objects'))
     no_clean_on_error = parsed_args.no_clean_on_error
     diffoscope = parsed_args.diffoscope
     if parsed_args.no_diffoscope:
@@ -819,19 +1462,44 @@ def run(argv, dry_run=None):
         print("No <artifact> to test for differences provided. See --help for options.")
         sys.exit(2)
 
-    testbed_args = TestbedArgs.of(virtual_server_args, testbed_pre, testbed_init, testbed_build_pre, host_distro)
+    if parsed_args.cpu_budget and not set(parsed_args.cpu_budget) <= os.sched_getaffinity(0):
+        print("--cpu-budget has CPUs that are not available to us: %s" % ", ".join(
+            str(c) for c in sorted(set(parsed_args.cpu_budget) - os.sched_getaffinity(0))))
+        sys.exit(2)
+
+    testbed_args = TestbedArgs.of(virtual_server_args, testbed_pre, testbed_init, testbed_build_pre, host_distro,
+                                  parsed_args.build_jobs, parsed_args.cpu_budget, parsed_args.memory_budget)
     test_args = TestArgs.of(build_command, source_root, artifact_pattern, store_dir,
-                            source_pattern, no_clean_on_error, diffoscope_args)
+                            source_pattern, no_clean_on_error, diffoscope_args,
+                            parsed_args.store_compression, parsed_args.scratch_dir,
+                            store_objects,
+                            parsed_args.diff_jobs,
+                            parsed_args.diff_cache and diffcache.DiffCache(
+                                parsed_args.diff_cache, parsed_args.diff_cache_size),
+                            parsed_args.diffoscope_server and
+                                diffoscope_server.DiffoscopeServer(),
+                            parsed_args.store_max_size,
+                            parsed_args.results_file and results.ResultsFile(parsed_args.results_file),
+                            parsed_args.compare_in_testbed, parsed_args.diff_summary)
 
     check_args = (test_args, testbed_args, build_variations)
     if dry_run:
         return check_args
     else:
+        if test_args.results:
+            test_args.results.start(check_func.__name__, store_dir)
+        retcode = 125
         try:
-            return 0 if check_func(*check_args) else 1
+            retcode = 0 if check_func(*check_args) else 1
+            return retcode
         except Exception:
             traceback.print_exc()
-            return 125
+            return retcode
+        finally:
+            if test_args.diffoscope_server:
+                test_args.diffoscope_server.close()
+            if test_args.results:
+                test_args.results.finish(retcode)
 
 
 def main():
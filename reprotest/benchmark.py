@@ -0,0 +1,142 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+"""Time the steps of the virtual server protocol, to compare servers.
+
+Run as `python3 -m reprotest.benchmark`; see --help.
+"""
+
+import argparse
+import collections
+import contextlib
+import getpass
+import json
+import logging
+import os
+import shlex
+import sys
+import tempfile
+import time
+
+from reprotest import Testbed, get_all_servers, get_server_path
+from reprotest.lib.adt_testbed import Path
+
+logger = logging.getLogger(__name__)
+
+STEPS = ["start", "open", "execute", "copydown", "copyup", "revert", "stop"]
+
+
+@contextlib.contextmanager
+def timed(results, step):
+    start = time.monotonic()
+    yield
+    results[step] = time.monotonic() - start
+
+
+def write_random_file(filename, size, chunk=1 << 20):
+    # random data, so that compressing transports don't skew the results
+    with open(filename, 'wb') as f:
+        while size > 0:
+            f.write(os.urandom(min(chunk, size)))
+            size -= chunk
+
+
+def benchmark_server(virtual_server_args, copy_size=100 << 20, host_distro=None):
+    """Run the protocol steps against one virtual server, and time them.
+
+    Returns an OrderedDict of step name to seconds; "revert" is None if the
+    server does not support it.
+    """
+    results = collections.OrderedDict()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        testbed = Testbed([get_server_path(virtual_server_args[0])] + virtual_server_args[1:],
+                          temp_dir, getpass.getuser(), host_distro=host_distro)
+        with timed(results, "start"):
+            testbed.start()
+        try:
+            with timed(results, "open"):
+                testbed.open()
+            with timed(results, "execute"):
+                testbed.check_exec(['true'])
+
+            host_down = os.path.join(temp_dir, 'copydown.bin')
+            write_random_file(host_down, copy_size)
+            tb_path = os.path.join(testbed.scratch, 'benchmark.bin')
+            with timed(results, "copydown"):
+                Path(testbed, host_down, tb_path, is_dir=False).copydown()
+            os.unlink(host_down)
+            with timed(results, "copyup"):
+                Path(testbed, os.path.join(temp_dir, 'copyup.bin'), tb_path, is_dir=False).copyup()
+
+            if 'revert' in testbed.caps:
+                with timed(results, "revert"):
+                    testbed._opened(testbed.command('revert', (), 1))
+            else:
+                results["revert"] = None
+        finally:
+            with timed(results, "stop"):
+                testbed.stop()
+    return results
+
+
+def benchmark_servers(servers, copy_size=100 << 20, host_distro=None):
+    """Benchmark each of servers, a list of virtual_server_args.
+
+    Servers that fail, e.g. because they are not usable on this system, get
+    an "error" entry instead of timings.
+    """
+    results = collections.OrderedDict()
+    for virtual_server_args in servers:
+        name = " ".join(map(shlex.quote, virtual_server_args))
+        logger.info("benchmarking virtual server: %s", name)
+        try:
+            results[name] = benchmark_server(virtual_server_args, copy_size, host_distro)
+        except Exception as e:
+            logger.warning("virtual server %s is not usable: %s", name, e)
+            results[name] = collections.OrderedDict([("error", str(e))])
+    return results
+
+
+def cli_parser():
+    parser = argparse.ArgumentParser(
+        prog='python3 -m reprotest.benchmark',
+        description='Time starting, opening, running a command in, copying '
+        'to and from, reverting and stopping virtual servers, and output the '
+        'results as JSON.')
+    parser.add_argument('--server', action='append', default=[], metavar='SERVER_ARGS',
+        help='Virtual server to benchmark, with its arguments as in reprotest\'s '
+        'virtual_server_args, e.g. "schroot unstable-amd64". May be given '
+        'several times. Default: every available server, without arguments; '
+        'the ones that need arguments are then reported as not usable. '
+        'Available: %s' % ", ".join(get_all_servers()))
+    parser.add_argument('--copy-size', type=int, default=100, metavar='MB',
+        help='Size of the file to copy down and up, in MiB. Default: %(default)s')
+    parser.add_argument('--host-distro', default=None,
+        help='The distribution that will run the tests (Default: %(default)s)')
+    parser.add_argument('--output', default=None, metavar='FILE',
+        help='Write the JSON results to FILE instead of standard output.')
+    parser.add_argument('--verbosity', type=int, default=0,
+        help='An integer.  Control which messages are displayed.')
+    return parser
+
+
+def main():
+    args = cli_parser().parse_args()
+    logging.basicConfig(level=30 - 10 * args.verbosity)
+    servers = [shlex.split(s) for s in args.server] or [[s] for s in get_all_servers()]
+    results = collections.OrderedDict([
+        ("copy_size", args.copy_size << 20),
+        ("steps", STEPS),
+        ("servers", benchmark_servers(servers, args.copy_size << 20, args.host_distro)),
+    ])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
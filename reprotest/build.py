@@ -310,8 +310,13 @@ def num_cpus(ctx, build, vary):
             then echo $CPU_MIN; echo >&2 "only 1 CPU is available; num_cpus is ineffective"; \
             else shuf -i$((CPU_MIN + 1))-$CPU_MAX -n1; fi)')
 
-    # select CPU_NUM random cpus from the range 0..$((CPU_MAX-1))
-    cpu_list = "$(echo $(shuf -i0-$((CPU_MAX - 1)) -n$CPU_NUM) | tr ' ' ,)"
+    # select CPU_NUM random cpus from the ones we may run on, which need not
+    # be 0..$((CPU_MAX-1)), e.g. with --cpu-budget
+    _ = _.append_setup_exec_raw('CPU_ALLOWED=$({ awk \'/^Cpus_allowed_list:/ { \
+        n = split($2, r, ","); for (i = 1; i <= n; i++) { \
+        m = split(r[i], b, "-"); for (c = b[1]; c <= b[m]; c++) print c } }\' \
+        /proc/self/status 2>/dev/null || seq 0 $((CPU_MAX - 1)); })')
+    cpu_list = '$(echo "$CPU_ALLOWED" | shuf -n$CPU_NUM | paste -sd, -)'
     return _.prepend_to_build_command_raw('taskset', '-a', '-c', cpu_list)
 
 # TODO: if this locale doesn't exist on the system, Python's
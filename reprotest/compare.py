@@ -0,0 +1,275 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+"""Quick comparison of two build output trees, for --no-diffoscope.
+
+Unlike diff(1) this does not compute the differences of files, it only finds
+out which files differ. Like diff -r, and diffoscope with its default
+--exclude-directory-metadata, it ignores the permissions, owners and
+timestamps of files.
+
+For ar (.deb), tar and zip archives that differ, it also finds out which of
+their members differ, recursing into nested archives, e.g.
+data.tar.xz:/usr/lib/foo.so. This is also used before running diffoscope.
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import io
+import logging
+import mmap
+import os
+import stat
+import tarfile
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 24
+
+# archive formats we look into, by file name
+ARCHIVE_SUFFIXES = collections.OrderedDict([
+    ('ar', ('.deb', '.udeb', '.ddeb', '.a')),
+    ('tar', ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')),
+    ('zip', ('.zip', '.jar', '.war', '.apk', '.whl')),
+])
+
+# number of differing members to list per archive
+MAX_MEMBERS_SHOWN = 20
+
+
+def scan_tree(top):
+    """Return a dict of the path relative to top to the lstat of every entry."""
+    entries = {}
+    pending = ['']
+    while pending:
+        reldir = pending.pop()
+        with os.scandir(os.path.join(top, reldir)) as it:
+            for entry in it:
+                relpath = os.path.join(reldir, entry.name)
+                entries[relpath] = entry.stat(follow_symlinks=False)
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(relpath)
+    return entries
+
+
+def file_type(st):
+    return stat.S_IFMT(st.st_mode)
+
+
+def same_contents(path_a, path_b, chunk_size=CHUNK_SIZE):
+    """Compare two regular files of the same size, stopping at the first
+    chunk that differs."""
+    with open(path_a, 'rb') as f_a, open(path_b, 'rb') as f_b:
+        size = os.fstat(f_a.fileno()).st_size
+        if size == 0:
+            # mmap cannot map empty files
+            return True
+        with mmap.mmap(f_a.fileno(), 0, access=mmap.ACCESS_READ) as m_a, \
+                mmap.mmap(f_b.fileno(), 0, access=mmap.ACCESS_READ) as m_b:
+            for offset in range(0, size, chunk_size):
+                if m_a[offset:offset + chunk_size] != m_b[offset:offset + chunk_size]:
+                    return False
+    return True
+
+
+def archive_format(name):
+    for fmt, suffixes in ARCHIVE_SUFFIXES.items():
+        if name.endswith(suffixes):
+            return fmt
+    return None
+
+
+class LimitedReader(io.RawIOBase):
+    """Read at most size bytes of f, e.g. one member of an ar archive."""
+
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.remaining:
+            return 0
+        n = self.f.readinto(memoryview(b)[:self.remaining])
+        self.remaining -= n
+        return n
+
+
+class HashingReader(io.RawIOBase):
+    """Read f, computing the SHA-256 of everything read."""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        self.sha256.update(memoryview(b)[:n])
+        return n
+
+    def hexdigest(self):
+        # what was not read, e.g. the padding of a tar archive, counts too
+        while self.read(CHUNK_SIZE):
+            pass
+        return self.sha256.hexdigest()
+
+
+def iter_ar(f):
+    """Yield (name, reader) of the members of the ar archive read from f."""
+    if f.read(8) != b'!<arch>\n':
+        raise ValueError("not an ar archive")
+    while True:
+        header = f.read(60)
+        if not header:
+            return
+        if len(header) != 60 or header[58:60] != b'`\n':
+            raise ValueError("truncated ar archive")
+        name = header[:16].decode('utf-8', 'surrogateescape').rstrip()
+        if name.endswith('/') and len(name) > 1:
+            # GNU ar terminates names with a slash
+            name = name[:-1]
+        size = int(header[48:58])
+        member = LimitedReader(f, size)
+        yield name, member
+        while member.read(CHUNK_SIZE):
+            pass
+        f.read(size % 2)
+
+
+def member_path(name):
+    # ./usr/lib/foo.so -> /usr/lib/foo.so
+    return name[1:] if name.startswith('./') else name
+
+
+def member_digests(f, fmt, prefix=''):
+    """Yield (path, SHA-256) of the members of the archive read from f.
+
+    Nested archives are recursed into; their own digest is yielded as well,
+    after their members.
+    """
+    if fmt == 'ar':
+        for name, member in iter_ar(f):
+            yield from _member_digests(member, prefix + name)
+    elif fmt == 'tar':
+        with tarfile.open(fileobj=f, mode='r|*') as tar:
+            for info in tar:
+                path = prefix + member_path(info.name)
+                if info.isfile():
+                    yield from _member_digests(tar.extractfile(info), path)
+                elif info.issym() or info.islnk():
+                    yield path, hashlib.sha256(
+                        ('-> ' + info.linkname).encode('utf-8', 'surrogateescape')).hexdigest()
+    elif fmt == 'zip':
+        if not f.seekable():
+            f = io.BytesIO(f.read())
+        with zipfile.ZipFile(f) as z:
+            for info in z.infolist():
+                if not info.is_dir():
+                    with z.open(info) as member:
+                        yield from _member_digests(member, prefix + info.filename)
+    else:
+        raise ValueError("unknown archive format: %s" % fmt)
+
+
+def _member_digests(f, path):
+    reader = HashingReader(f)
+    fmt = archive_format(path)
+    if fmt:
+        yield from member_digests(reader, fmt, path + ':')
+    yield path, reader.hexdigest()
+
+
+def compare_archives(path_a, path_b):
+    """Return the sorted paths of the members that differ between two archives.
+
+    Paths of members of nested archives look like data.tar.xz:/usr/lib/foo.so;
+    a nested archive is only listed itself if none of its members differ. An
+    empty list means that only the archives' own metadata, e.g. timestamps or
+    the order of their members, differ. Returns None if path_a is not an
+    archive that we can read.
+    """
+    fmt = archive_format(path_a)
+    if not fmt:
+        return None
+    try:
+        with open(path_a, 'rb') as f_a, open(path_b, 'rb') as f_b:
+            members_a = dict(member_digests(f_a, fmt))
+            members_b = dict(member_digests(f_b, fmt))
+    except Exception as e:
+        logger.debug("could not compare the members of %s and %s: %s", path_a, path_b, e)
+        return None
+    differ = set(p for p in members_a.keys() | members_b.keys()
+                 if members_a.get(p) != members_b.get(p))
+    return sorted(p for p in differ
+                  if not any(q.startswith(p + ':') for q in differ))
+
+
+def compare_trees(dir_a, dir_b, jobs=1):
+    """Compare the trees below dir_a and dir_b.
+
+    Returns a sorted list of (relative path, reason) of the entries that
+    differ. The contents of files of the same size, and the members of
+    archives, are compared on up to jobs threads.
+    """
+    entries_a, entries_b = scan_tree(dir_a), scan_tree(dir_b)
+    differences = []
+    to_compare = []
+    for relpath in sorted(entries_a.keys() | entries_b.keys()):
+        st_a, st_b = entries_a.get(relpath), entries_b.get(relpath)
+        if st_b is None:
+            differences.append((relpath, "only in %s" % dir_a))
+        elif st_a is None:
+            differences.append((relpath, "only in %s" % dir_b))
+        elif file_type(st_a) != file_type(st_b):
+            differences.append((relpath, "file type"))
+        elif stat.S_ISLNK(st_a.st_mode):
+            if os.readlink(os.path.join(dir_a, relpath)) != os.readlink(os.path.join(dir_b, relpath)):
+                differences.append((relpath, "symlink target"))
+        elif stat.S_ISREG(st_a.st_mode):
+            if st_a.st_size != st_b.st_size and not archive_format(relpath):
+                differences.append((relpath, "size %s != %s" % (st_a.st_size, st_b.st_size)))
+            else:
+                to_compare.append(relpath)
+
+    def compare_file(relpath):
+        path_a, path_b = os.path.join(dir_a, relpath), os.path.join(dir_b, relpath)
+        size_a, size_b = os.path.getsize(path_a), os.path.getsize(path_b)
+        if size_a == size_b and same_contents(path_a, path_b):
+            return None
+        members = compare_archives(path_a, path_b)
+        if members is not None:
+            return archive_reason(members)
+        elif size_a != size_b:
+            return "size %s != %s" % (size_a, size_b)
+        return "contents"
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for relpath, reason in zip(to_compare, pool.map(compare_file, to_compare)):
+            if reason:
+                differences.append((relpath, reason))
+    return sorted(differences)
+
+
+def archive_reason(members):
+    if not members:
+        return "archive metadata only"
+    shown = members[:MAX_MEMBERS_SHOWN]
+    if len(members) > len(shown):
+        shown.append("%s more" % (len(members) - len(shown)))
+    return "members: " + ", ".join(shown)
+
+
+def format_differences(differences, dir_a, dir_b):
+    """Return the report of compare_trees() as text, one line per path."""
+    if not differences:
+        return ""
+    lines = ["Files differ between %s and %s:" % (dir_a, dir_b)]
+    lines.extend("  %s (%s)" % (relpath, reason) for relpath, reason in differences)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,147 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import lzma
+import os
+import re
+import shutil
+import stat
+import tempfile
+
+from reprotest.compare import scan_tree
+from reprotest.utils import sha256_file
+
+logger = logging.getLogger(__name__)
+
+
+def tree_digest(top, metadata=False, jobs=1):
+    """Return the SHA-256 of the names, types and contents of a tree.
+
+    If metadata is true, the permissions and timestamps of the entries are
+    included as well. The files are hashed on up to jobs threads.
+    """
+    entries = sorted(scan_tree(top).items())
+    files = [relpath for relpath, st in entries if stat.S_ISREG(st.st_mode)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        digests = dict(zip(files, pool.map(lambda p: sha256_file(os.path.join(top, p)), files)))
+    h = hashlib.sha256()
+    for relpath, st in entries:
+        if stat.S_ISLNK(st.st_mode):
+            content = os.readlink(os.path.join(top, relpath))
+        else:
+            content = digests.get(relpath, '')
+        fields = [relpath, stat.S_IFMT(st.st_mode), content]
+        if metadata:
+            fields += [stat.S_IMODE(st.st_mode), st.st_mtime_ns]
+        h.update(json.dumps(fields).encode('utf-8', 'surrogateescape') + b'\n')
+    return h.hexdigest()
+
+
+class DiffCache(object):
+    """Cache of the results of diffoscope, keyed by what it compared.
+
+    Each entry is <key>.json, with the exit code and the paths that were
+    compared, and <key>.out.xz, with the output; the paths in that are
+    replaced by the ones of the current comparison when it is reused. When
+    the entries take more than max_size bytes, the least recently used ones
+    are removed.
+    """
+
+    def __init__(self, cache_dir, max_size=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, dist_0, dist_1, diffoscope_args, metadata=False, jobs=1, max_size=None):
+        """Return the key of diffing dist_0 and dist_1 with diffoscope_args.
+
+        max_size is the --store-max-size that the saved output is cut after.
+        """
+        h = hashlib.sha256(json.dumps([
+            tree_digest(dist_0, metadata, jobs),
+            tree_digest(dist_1, metadata, jobs),
+            diffoscope_args, max_size]).encode('utf-8', 'surrogateescape'))
+        return h.hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.json', base + '.out.xz'
+
+    def get(self, key, dist_0, dist_1):
+        """Return (exit code, output) of the entry for key, or None.
+
+        output is an iterator over the lines of the output, which are only
+        read from the cache as it is consumed.
+        """
+        meta_path, out_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            out = lzma.open(out_path)
+            for path in (meta_path, out_path):
+                os.utime(path)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning("Ignoring broken diff cache entry %s: %s", key, e)
+            return None
+        paths = {os.fsencode(meta['dist_0']): os.fsencode(dist_0),
+                 os.fsencode(meta['dist_1']): os.fsencode(dist_1)}
+        pattern = re.compile(b'|'.join(re.escape(p) for p in paths))
+
+        def output():
+            with out:
+                try:
+                    for line in out:
+                        yield pattern.sub(lambda m: paths[m.group(0)], line)
+                except (OSError, EOFError, lzma.LZMAError) as e:
+                    logger.warning("Diff cache entry %s is broken, its output is incomplete: %s",
+                                   key, e)
+                    self.remove(key)
+        return meta['retcode'], output()
+
+    def put(self, key, dist_0, dist_1, retcode, output_file):
+        """Add the output of diffoscope, saved in the file output_file."""
+        meta_path, out_path = self._paths(key)
+        # the .json is written last, so that entries with one are complete
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp.')
+        os.close(fd)
+        with open(output_file, 'rb') as src, lzma.open(tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        os.replace(tmp, out_path)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'retcode': retcode, 'dist_0': dist_0, 'dist_1': dist_1}, f)
+        os.replace(tmp, meta_path)
+        self.evict()
+
+    def remove(self, key):
+        for path in self._paths(key):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        """Remove the least recently used entries until they fit max_size."""
+        entries = {}
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith('.tmp.'):
+                continue
+            key = entry.name.partition('.')[0]
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            size, last_used = entries.get(key, (0, 0))
+            entries[key] = (size + st.st_size, max(last_used, st.st_mtime))
+        total = sum(size for size, _ in entries.values())
+        for key, (size, _) in sorted(entries.items(), key=lambda e: e[1][1]):
+            if total <= self.max_size:
+                break
+            logger.info("Removing diff cache entry %s", key)
+            self.remove(key)
+            total -= size
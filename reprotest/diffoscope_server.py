@@ -0,0 +1,183 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+"""Run diffoscope in forks of a process that imported it once.
+
+Starting diffoscope takes seconds, mostly for importing its comparators. With
+--diffoscope-server, reprotest starts this module as a server once, which
+imports diffoscope and then forks a child for each comparison. The child gets
+the stdout and stderr of the caller, so it writes its output to the same
+places as a diffoscope subprocess would, and returns the same exit code.
+
+This file is run as a script and only uses the standard library, so that it
+does not need reprotest to be importable.
+"""
+
+import array
+import json
+import logging
+import os
+import selectors
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def send_fds(sock, buffers, fds):
+    """Like socket.send_fds(), which needs Python 3.9."""
+    return sock.sendmsg(buffers, [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+
+def recv_fds(sock, bufsize, maxfds):
+    """Like socket.recv_fds(), which needs Python 3.9; return (msg, fds)."""
+    fds = array.array('i')
+    msg, ancdata, _, _ = sock.recvmsg(bufsize, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    return msg, list(fds)
+
+
+def handle(conn, diffoscope_main):
+    """Run one comparison in a forked child, and send back its exit code."""
+    msg, fds = recv_fds(conn, 1 << 20, 2)
+    request = json.loads(msg.decode('utf-8', 'surrogateescape'))
+    null = os.open(os.devnull, os.O_RDONLY)
+    for fd, target in zip([null] + fds, [0, 1, 2]):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request['cwd'])
+    sys.argv = request['argv']
+    try:
+        diffoscope_main(request['argv'][1:])
+        code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.sendall(b'%d' % code)
+
+
+def serve(sock_path):
+    try:
+        from diffoscope.main import main as diffoscope_main
+    except ImportError as e:
+        print("cannot import diffoscope: %s" % e, file=sys.stderr)
+        return 2
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    listener.bind(sock_path)
+    listener.listen(16)
+    # reap the children automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    print("ready", flush=True)
+
+    sel = selectors.DefaultSelector()
+    sel.register(listener, selectors.EVENT_READ)
+    sel.register(sys.stdin, selectors.EVENT_READ)
+    while True:
+        for key, _ in sel.select():
+            if key.fileobj is sys.stdin:
+                # reprotest went away
+                if not os.read(sys.stdin.fileno(), 4096):
+                    return 0
+                continue
+            conn, _ = listener.accept()
+            if os.fork() == 0:
+                try:
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    sel.close()
+                    listener.close()
+                    handle(conn, diffoscope_main)
+                finally:
+                    os._exit(0)
+            conn.close()
+
+
+class DiffoscopeServer(object):
+    """Client of the server, started on first use.
+
+    run() can be used from several threads at the same time.
+    """
+
+    def __init__(self):
+        self.proc = None
+        self.tmpdir = None
+        self.lock = threading.Lock()
+
+    @property
+    def sock_path(self):
+        return os.path.join(self.tmpdir, 'socket')
+
+    def start(self):
+        with self.lock:
+            if self.proc:
+                return
+            self.tmpdir = tempfile.mkdtemp(prefix='reprotest-diffoscope.')
+            logger.info("Starting diffoscope server")
+            self.proc = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), self.sock_path],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            if self.proc.stdout.readline() != b'ready\n':
+                returncode = self.proc.wait()
+                self.proc = None
+                raise RuntimeError("diffoscope server failed to start, exit status %s" %
+                                   returncode)
+
+    def run(self, args, stdout=None, cwd=None):
+        """Like subprocess.run() of diffoscope with args; args[0] is ignored.
+
+        stdout may be None, subprocess.PIPE, a file descriptor or a file.
+        """
+        self.start()
+        capture = stdout == subprocess.PIPE
+        if capture:
+            read_fd, out_fd = os.pipe()
+        elif stdout is None:
+            sys.stdout.flush()
+            out_fd = sys.stdout.fileno()
+        elif isinstance(stdout, int):
+            out_fd = stdout
+        else:
+            out_fd = stdout.fileno()
+        request = {'argv': list(args), 'cwd': os.path.abspath(cwd or os.getcwd())}
+        output = None
+        with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as conn:
+            conn.connect(self.sock_path)
+            send_fds(conn, [json.dumps(request).encode('utf-8', 'surrogateescape')],
+                     [out_fd, sys.stderr.fileno()])
+            if capture:
+                os.close(out_fd)
+                with open(read_fd, 'rb') as f:
+                    output = f.read()
+            reply = conn.recv(64)
+        if not reply:
+            logger.error("diffoscope server child died while running %r", args)
+            returncode = 2
+        else:
+            returncode = int(reply)
+        return subprocess.CompletedProcess(args, returncode, output)
+
+    def close(self):
+        with self.lock:
+            if self.proc:
+                self.proc.stdin.close()
+                self.proc.wait()
+                self.proc = None
+            if self.tmpdir:
+                shutil.rmtree(self.tmpdir, ignore_errors=True)
+                self.tmpdir = None
+
+
+if __name__ == '__main__':
+    sys.exit(serve(sys.argv[1]))
@@ -48,6 +48,12 @@ auxverb = None  # prefix to run command argv in testbed
 cleaning = False
 in_mainloop = False
 
+# commands which may run concurrently with later ones when the caller tags
+# them with a request id (see command()); all others wait for these to finish
+concurrent_commands = ('capabilities', 'print-execute-command',
+                       'copydown', 'copyup')
+concurrent_pending = {}  # pid of forked child -> request tag
+
 
 class Quit(RuntimeError):
 
@@ -101,7 +107,7 @@ def cmdnumargs(c, ce, nargs=0, noptargs=0):
 
 def cmd_capabilities(c, ce):
     cmdnumargs(c, ce)
-    return caller.hook_capabilities()
+    return caller.hook_capabilities() + ['pipelined']
 
 
 def cmd_quit(c, ce):
@@ -265,6 +271,45 @@ def cmd_open(c, ce):
     return [downtmp]
 
 
+def parse_size(size):
+    '''Return the bytes in a size like 512k, 4G or 50% (of the RAM)'''
+
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    size = size.strip().lower()
+    if size.endswith('%'):
+        ram = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        return int(ram * float(size[:-1]) / 100)
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def parse_cpu_list(cpus):
+    '''Return the CPU numbers in a list like 0-3,8 as a sorted list'''
+
+    result = set()
+    for r in cpus.split(','):
+        (first, _, last) = r.strip().partition('-')
+        result.update(range(int(first), int(last or first) + 1))
+    return sorted(result)
+
+
+def format_cpu_list(cpus):
+    return ','.join(str(c) for c in cpus)
+
+
+def testbed_limits():
+    '''Return the (CPU list, memory bytes) reprotest allotted to this testbed
+
+    Either is None if there is no limit. Servers which don't run commands on
+    the host (where reprotest enforces these itself) should apply them to
+    their VMs or containers.
+    '''
+    cpus = os.environ.get('REPROTEST_TESTBED_CPUS')
+    memory = os.environ.get('REPROTEST_TESTBED_MEMORY')
+    return (cpus and parse_cpu_list(cpus), memory and int(memory))
+
+
 def downtmp_mktemp(path):
     '''Generate a downtmp
 
@@ -612,6 +657,52 @@ def cmd_shell(c, ce):
             adtlog.error('Cannot run shell: %s' % e)
 
 
+def run_concurrent(tag, f, c, ce):
+    '''Run a tagged command in a forked child
+
+    The main loop can then accept further commands while this one runs; the
+    child prints its own reply, prefixed with the request tag.
+    '''
+    reap_concurrent(False)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        concurrent_pending[pid] = tag
+        return
+
+    # child: never run the testbed cleanup from here
+    sethandlers(signal.SIG_DFL)
+    try:
+        r = f(c, ce) or []
+        r.insert(0, 'ok')
+    except FailedCmd as fc:
+        r = fc.e
+    except Quit as q:
+        sys.stderr.write(q.m)
+        sys.stderr.write('\n')
+        r = ['failed']
+    except:
+        traceback.print_exc()
+        r = ['failed']
+    # a single short write() to a pipe is atomic, so replies don't interleave
+    os.write(1, (' '.join([tag] + r) + '\n').encode())
+    os._exit(0)
+
+
+def reap_concurrent(block=True):
+    '''Collect finished concurrent commands; wait for all of them if block'''
+
+    for pid in list(concurrent_pending):
+        try:
+            (p, status) = os.waitpid(pid, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            p = pid
+        if p:
+            adtlog.debug('concurrent command %s finished' % concurrent_pending[pid])
+            del concurrent_pending[pid]
+
+
 def command():
     sys.stdout.flush()
     while True:
@@ -633,6 +724,10 @@ def command():
     if not ce:
         bomb('end of file - caller quit?')
     ce = ce.rstrip().split()
+    # pipelined requests are prefixed with "@<id>", which we echo in the reply
+    tag = None
+    if ce and ce[0].startswith('@'):
+        tag = ce.pop(0)
     c = list(map(url_unquote, ce))
     if not c:
         bomb('empty commands are not permitted')
@@ -642,6 +737,11 @@ def command():
         f = globals()['cmd_' + c_lookup]
     except KeyError:
         bomb("unknown command `%s'" % ce[0])
+    if tag and c[0] in concurrent_commands:
+        run_concurrent(tag, f, c, ce)
+        return
+    # everything else may change the testbed state, so acts as a barrier
+    reap_concurrent()
     try:
         r = f(c, ce)
         if not r:
@@ -649,6 +749,8 @@ def command():
         r.insert(0, 'ok')
     except FailedCmd as fc:
         r = fc.e
+    if tag:
+        r.insert(0, tag)
     print(' '.join(r))
 
 
@@ -668,6 +770,7 @@ def cleanup():
     # avoid recursion if something bomb()s in hook_cleanup()
     if not cleaning:
         cleaning = True
+        reap_concurrent()
         if downtmp:
             caller.hook_cleanup()
         cleaning = False
@@ -22,6 +22,7 @@
 
 import os
 import sys
+import atexit
 import errno
 import time
 import pipes
@@ -41,6 +42,7 @@ from reprotest.lib.system_interface.debian import DebianInterface
 from reprotest.lib.system_interface.arch import ArchInterface
 from reprotest.lib import adtlog
 from reprotest.lib import VirtSubproc
+from reprotest import stream
 
 SYSTEM_INTERFACES = {
         'debian': DebianInterface,
@@ -57,6 +59,9 @@ class Testbed:
                  copy_files=[], host_distro=None):
         self.sp = None
         self.lastsend = None
+        self.pipelined = False
+        self.last_request = 0
+        self.replies = {}  # request tag -> reply line, or result if not pipelined
         self.scratch = None
         self.modified = False
         self._need_reset_apt = False
@@ -81,6 +86,9 @@ class Testbed:
         self.eatmydata_prefix = []
         self.apt_pin_for_pockets = []
         self.nproc = None
+        # cgroup v2 interface file -> value, for the cgroups of commands
+        self.cgroup_limits = {}
+        self.host_commands = host_server(vserver_argv)
         self.cpu_model = None
         self.cpu_flags = None
 
@@ -233,6 +241,7 @@ class Testbed:
         self.exec_cmd = list(map(urllib.parse.unquote, self.command('print-execute-command', (), 1)[0].split(',')))
         self.caps = self.command('capabilities', (), None)
         adtlog.debug('testbed capabilities: %s' % self.caps)
+        self.pipelined = 'pipelined' in self.caps
         for c in self.caps:
             if c.startswith('downtmp-host='):
                 self.shared_downtmp = c.split('=', 1)[1]
@@ -389,14 +398,32 @@ class Testbed:
             self.bomb('cannot send to testbed: %s' % traceback.
                       format_exception_only(type, value))
 
-    def expect(self, keyword, nresults):
-        line = self.sp.stdout.readline()
-        if not line:
-            self.bomb('unexpected eof from the testbed')
-        if not line.endswith('\n'):
-            self.bomb('unterminated line from the testbed')
-        line = line.rstrip('\n')
-        adtlog.debug('got reply from testbed: ' + line)
+    def read_reply(self, tag=None):
+        '''Read a reply line from the testbed
+
+        Replies to pipelined requests are prefixed with their request tag; they
+        are stashed until somebody asks for them. Return the first untagged
+        line if tag is None, otherwise the reply for tag.
+        '''
+        while tag is None or tag not in self.replies:
+            line = self.sp.stdout.readline()
+            if not line:
+                self.bomb('unexpected eof from the testbed')
+            if not line.endswith('\n'):
+                self.bomb('unterminated line from the testbed')
+            line = line.rstrip('\n')
+            adtlog.debug('got reply from testbed: ' + line)
+            if line.startswith('@'):
+                (t, _, line) = line.partition(' ')
+                self.replies[t] = line
+            elif tag is not None:
+                self.bomb("got untagged reply `%s' while waiting for %s" % (line, tag))
+            else:
+                return line
+        return self.replies.pop(tag)
+
+    def expect(self, keyword, nresults, tag=None):
+        line = self.read_reply(tag)
         ll = line.split()
         if not ll:
             self.bomb('unexpected whitespace-only line from the testbed')
@@ -414,7 +441,7 @@ class Testbed:
                       (self.lastsend, line, len(ll), nresults))
         return ll
 
-    def command(self, cmd, args=(), nresults=0, unquote=True):
+    def format_command(self, cmd, args=()):
         # pass args=[None,...] or =(None,...) to avoid more url quoting
         if type(cmd) is str:
             cmd = [cmd]
@@ -422,20 +449,58 @@ class Testbed:
             args = args[1:]
         else:
             args = list(map(urllib.parse.quote, args))
-        al = cmd + args
-        self.send(' '.join(al))
+        return ' '.join(cmd + args)
+
+    def command(self, cmd, args=(), nresults=0, unquote=True):
+        self.send(self.format_command(cmd, args))
         ll = self.expect('ok', nresults)
         if unquote:
             ll = list(map(urllib.parse.unquote, ll))
         return ll
 
-    def execute(self, argv, xenv=[], stdout=None, stderr=None, kind='short'):
+    def command_async(self, cmd, args=()):
+        '''Send a command without waiting for its reply
+
+        If the testbed supports pipelining, the command is tagged with a
+        request id and the virt server may run it concurrently with other
+        commands and with execute(); otherwise it is run synchronously here.
+        Either way, return a tag to pass to command_wait().
+        '''
+        self.last_request += 1
+        tag = '@%i' % self.last_request
+        if self.pipelined:
+            self.send(tag + ' ' + self.format_command(cmd, args))
+        else:
+            self.replies[tag] = self.command(cmd, args, None, unquote=False)
+        return tag
+
+    def command_wait(self, tag, nresults=0, unquote=True):
+        '''Wait for the reply to a command sent with command_async()'''
+
+        if self.pipelined:
+            ll = self.expect('ok', nresults, tag)
+        else:
+            ll = self.replies.pop(tag)
+            if nresults is not None and len(ll) != nresults:
+                self.bomb("got %d result parameters for %s, expected %d" %
+                          (len(ll), tag, nresults))
+        if unquote:
+            ll = list(map(urllib.parse.unquote, ll))
+        return ll
+
+    def execute(self, argv, xenv=[], stdout=None, stderr=None, kind='short',
+                tee=None, tee_err=None):
         '''Run command in testbed.
 
         The commands stdout/err will be piped directly to autopkgtest and its log
         files, unless redirection happens with the stdout/stderr arguments
         (passed to Popen).
 
+        If tee is given, stdout is streamed into its write() method as the
+        command runs, instead of being captured, and so is stderr, into the
+        one of tee_err if given, otherwise merged into tee. This keeps memory
+        use bounded for arbitrarily chatty commands.
+
         Return (exit code, stdout, stderr). stdout/err will be None when output
         is not redirected.
         '''
@@ -447,30 +512,57 @@ class Testbed:
         env += self.install_tmp_env
 
         adtlog.debug('testbed command %s, kind %s, sout %s, serr %s, env %s' %
-                     (argv, kind, stdout and 'pipe' or 'raw',
-                      stderr and 'pipe' or 'raw', env))
+                     (argv, kind, (stdout or tee) and 'pipe' or 'raw',
+                      (stderr or tee) and 'pipe' or 'raw', env))
 
         if env:
             argv = ['env'] + env + argv
 
+        # run the command in its own cgroup, so that we can reliably kill it
+        # together with everything it spawned, and limit its resources; that
+        # only makes sense if it runs on the host
+        cgroup = self.host_commands and cgroup_create(self.cgroup_limits)
+        cmd = self.exec_cmd + argv
+        if cgroup:
+            cmd = cgroup_wrap(cgroup, cmd)
+        killed = False
+
         VirtSubproc.timeout_start(timeouts[kind])
         try:
-            proc = subprocess.Popen(self.exec_cmd + argv,
-                                    stdin=self.devnull,
-                                    stdout=stdout, stderr=stderr)
-            (out, err) = proc.communicate()
-            if out is not None:
-                out = out.decode()
-            if err is not None:
-                err = err.decode()
+            if tee:
+                proc = subprocess.Popen(cmd,
+                                        stdin=self.devnull,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE if tee_err else subprocess.STDOUT)
+                tees = {proc.stdout: tee}
+                if tee_err:
+                    tees[proc.stderr] = tee_err
+                try:
+                    stream.pump(tees)
+                finally:
+                    for f in tees:
+                        f.close()
+                proc.wait()
+                (out, err) = (None, None)
+            else:
+                proc = subprocess.Popen(cmd,
+                                        stdin=self.devnull,
+                                        stdout=stdout, stderr=stderr)
+                (out, err) = proc.communicate()
+                if out is not None:
+                    out = out.decode()
+                if err is not None:
+                    err = err.decode()
             VirtSubproc.timeout_stop()
         except VirtSubproc.Timeout:
-            # This is a bit of a hack, but what can we do.. we can't kill/clean
-            # up sudo processes, we can only hope that they clean up themselves
-            # after we stop the testbed
-            killtree(proc.pid)
+            # Without a cgroup this is a bit of a hack, but what can we do.. we
+            # can't kill/clean up sudo processes, we can only hope that they
+            # clean up themselves after we stop the testbed
+            killed = cgroup and cgroup_kill(cgroup)
+            if not killed:
+                killtree(proc.pid)
             adtlog.debug('timed out on %s %s (kind: %s)' % (self.exec_cmd, argv, kind))
-            if 'sudo' not in self.exec_cmd:
+            if killed or 'sudo' not in self.exec_cmd:
                 proc.wait()
             msg = 'timed out on command "%s" (kind: %s)' % (' '.join(argv), kind)
             if kind == 'test':
@@ -478,6 +570,9 @@ class Testbed:
                 raise
             else:
                 self.bomb(msg)
+        finally:
+            if cgroup:
+                cgroup_remove(cgroup, wait=killed)
 
         adtlog.debug('testbed command exited with code %i' % proc.returncode)
 
@@ -1335,22 +1430,312 @@ class TempPath(Path):
 #
 
 
-def child_ps(pid):
-    '''Get all child processes of pid'''
+def child_ps():
+    '''Get a map of all processes to their child processes
 
-    try:
-        out = subprocess.check_output(['ps', '-o', 'pid=', '--ppid', str(pid)])
-        return [int(p) for p in out.split()]
-    except subprocess.CalledProcessError:
-        return []
+    This does a single scan of /proc, which is much cheaper than asking ps for
+    the children of each process separately.
+    '''
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the command name in parentheses may contain spaces
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    return children
 
 
 def killtree(pid):
-    '''Recursively kill pid and all of its children'''
+    '''Kill pid and all of its children
+
+    The processes are pinned with pidfds (where available) before signalling
+    them, so that we cannot hit recycled pids. We rescan a few times to catch
+    processes that were forked while we were at it.
+    '''
+    pidfds = {}
+    for scan in range(3):
+        children = child_ps()
+        tree = [pid]
+        for p in tree:
+            tree += children.get(p, [])
+        new = [p for p in tree if p not in pidfds]
+        if not new:
+            break
+        for p in new:
+            try:
+                pidfds[p] = os.pidfd_open(p) if hasattr(os, 'pidfd_open') else None
+            except OSError:
+                pidfds[p] = None
+        for p in new:
+            try:
+                if pidfds[p] is not None:
+                    signal.pidfd_send_signal(pidfds[p], signal.SIGTERM)
+                else:
+                    os.kill(p, signal.SIGTERM)
+            except OSError:
+                pass
+    for fd in pidfds.values():
+        if fd is not None:
+            os.close(fd)
+
+
+# virtual servers whose commands run as processes on the host, so that we can
+# put them into cgroups; for the others, they run in a VM or container
+HOST_SERVERS = ('null', 'chroot', 'schroot', 'unshare')
+
+# cgroup below which cgroup_create() creates those of commands with limits;
+# None if not set up yet, False if there is none we can use
+cgroup_base = None
+# (leaf cgroup, our pid) of cgroup_prepare(), for cgroup_restore()
+cgroup_moved = None
+# controllers which cgroup_prepare() enabled
+cgroup_enabled = []
+# limits that could not be applied, to warn about each one only once
+cgroup_unapplied = set()
+
+
+def host_server(vserver_argv):
+    '''Whether the commands of virtual server vserver_argv run on the host'''
+
+    name = os.path.basename(vserver_argv[0])
+    if name.startswith('autopkgtest-virt-'):
+        name = name[len('autopkgtest-virt-'):]
+    return name in HOST_SERVERS
+
 
-    for child in child_ps(pid):
-        killtree(child)
+def cgroup_own():
+    '''Return the path of our own cgroup v2, or None if there is none'''
+
+    try:
+        with open('/proc/self/mountinfo') as f:
+            for line in f:
+                fields = line.split()
+                if fields[fields.index('-') + 1] == 'cgroup2' and fields[3] == '/':
+                    mountpoint = fields[4]
+                    break
+            else:
+                return None
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                if line.startswith('0::'):
+                    return mountpoint + line[3:].strip().rstrip('/')
+    except OSError as e:
+        adtlog.debug('cannot find own cgroup: %s' % e)
+    return None
+
+
+def cgroup_move(pids, path):
+    for pid in pids:
+        try:
+            with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+                f.write(str(pid))
+        except ProcessLookupError:
+            pass
+
+
+def cgroup_prepare(limits):
+    '''Set up the cgroup below which to create those with limits, and return it
+
+    That is our own cgroup, with the controllers of limits enabled for its
+    children. That is only possible if it has no processes of its own, so this
+    moves our process tree into a leaf child first, and cgroup_restore() moves
+    it back when we exit. Other processes in our cgroup, like the shell that
+    started us, are left alone, so in that case we cannot apply limits; use e.g.
+    systemd-run --user --scope -p Delegate=yes to start reprotest in a cgroup
+    of its own. Call this before forking processes which create cgroups, so
+    that they do not race for it. Return None if we cannot apply limits.
+    '''
+    global cgroup_base, cgroup_moved
+
+    if cgroup_base is not None:
+        return cgroup_base or None
+    cgroup_base = False
+    base = cgroup_own()
+    if not base:
+        return None
+    controllers = sorted(set(name.split('.')[0] for name in limits))
+    try:
+        with open(os.path.join(base, 'cgroup.controllers')) as f:
+            available = f.read().split()
+    except OSError as e:
+        adtlog.debug('cannot read controllers of cgroup %s: %s' % (base, e))
+        return None
+    for name in limits:
+        if name.split('.')[0] not in available:
+            cgroup_unapplied_warning(name, 'the %s controller is not available in '
+                                     'cgroup %s' % (name.split('.')[0], base))
+    controllers = [c for c in controllers if c in available]
+    if not controllers:
+        return None
+    try:
+        # the root cgroup may have processes and enabled controllers
+        if os.path.exists(os.path.join(base, 'cgroup.type')):
+            leaf = os.path.join(base, 'reprotest.%i' % os.getpid())
+            os.mkdir(leaf)
+            cgroup_moved = (leaf, os.getpid())
+            atexit.register(cgroup_restore)
+            children = child_ps()
+            tree = [os.getpid()]
+            for p in tree:
+                tree += children.get(p, [])
+            cgroup_move(tree, leaf)
+        for controller in controllers:
+            with open(os.path.join(base, 'cgroup.subtree_control'), 'w') as f:
+                f.write('+' + controller)
+            cgroup_enabled.append(controller)
+    except OSError as e:
+        if e.errno == errno.EBUSY:
+            e = '%s has other processes, run reprotest in a cgroup of its own' % base
+        for name in limits:
+            cgroup_unapplied_warning(name, str(e))
+        cgroup_restore()
+        return None
+    cgroup_base = base
+    return base
+
+
+def cgroup_restore():
+    '''Undo cgroup_prepare(), moving our processes back to our own cgroup'''
+
+    global cgroup_moved
+
+    if not cgroup_moved or cgroup_moved[1] != os.getpid():
+        return
+    (leaf, _) = cgroup_moved
+    base = os.path.dirname(leaf)
+    cgroup_moved = None
+    # processes can only go back once the controllers are disabled again; but
+    # leave them to other reprotest processes that use them
+    if not [d for d in os.listdir(base) if d.startswith('reprotest.') and
+            os.path.join(base, d) != leaf]:
+        for controller in cgroup_enabled:
+            try:
+                with open(os.path.join(base, 'cgroup.subtree_control'), 'w') as f:
+                    f.write('-' + controller)
+            except OSError as e:
+                adtlog.debug('cannot disable %s controller in cgroup %s: %s' % (controller, base, e))
+    del cgroup_enabled[:]
+    try:
+        for retry in range(10):
+            with open(os.path.join(leaf, 'cgroup.procs')) as f:
+                pids = f.read().split()
+            if not pids:
+                break
+            cgroup_move(pids, base)
+        os.rmdir(leaf)
+    except OSError as e:
+        adtlog.debug('cannot move processes back from cgroup %s: %s' % (leaf, e))
+
+
+def cgroup_unapplied_warning(name, reason):
+    if name not in cgroup_unapplied:
+        cgroup_unapplied.add(name)
+        adtlog.warning('cannot apply %s limit to commands: %s' % (name, reason))
+
+
+def cgroup_create(limits={}):
+    '''Create a new cgroup v2 for a command
+
+    With limits, which maps cgroup interface files like memory.max to values to
+    write to them, that is below the cgroup from cgroup_prepare(), otherwise
+    below our own one. We warn about limits that we cannot apply. Return its
+    path, or None if there is no cgroup v2 hierarchy or we cannot create
+    cgroups in it.
+    '''
+    base = cgroup_prepare(limits) if limits else cgroup_own()
+    if not base:
+        return None
+    try:
+        path = tempfile.mkdtemp(prefix='autopkgtest.', dir=base)
+    except OSError as e:
+        adtlog.debug('cannot create cgroup: %s' % e)
+        for name in limits:
+            cgroup_unapplied_warning(name, str(e))
+        return None
+    for (name, value) in limits.items():
+        try:
+            with open(os.path.join(path, name), 'w') as f:
+                f.write(value)
+        except FileNotFoundError:
+            cgroup_unapplied_warning(name, 'the %s controller is not available '
+                                     'in cgroup %s' % (name.split('.')[0], base))
+        except OSError as e:
+            cgroup_unapplied_warning(name, str(e))
+    return path
+
+
+def cgroup_wrap(path, argv):
+    '''Return argv wrapped to move itself into cgroup path before exec
+
+    This is done by a shell rather than in preexec_fn, which is not safe in
+    our threads. If the cgroup is not delegated to us, the command runs
+    outside of it and callers fall back to killtree().
+    '''
+    return ['sh', '-c', '{ echo $$ > "$0/cgroup.procs"; } 2>/dev/null; exec "$@"',
+            path] + argv
+
+
+def cgroup_kill(path):
+    '''Kill all processes in cgroup path
+
+    Return False if the cgroup has no processes, i. e. the command could not
+    be moved into it.
+    '''
+    procs = os.path.join(path, 'cgroup.procs')
     try:
-        os.kill(pid, signal.SIGTERM)
-    except OSError:
+        with open(procs) as f:
+            if not f.read().split():
+                return False
+    except OSError as e:
+        adtlog.debug('cannot kill cgroup %s: %s' % (path, e))
+        return False
+    try:
+        with open(os.path.join(path, 'cgroup.kill'), 'w') as f:
+            f.write('1')
+        return True
+    except FileNotFoundError:
         pass
+    except OSError as e:
+        adtlog.debug('cannot kill cgroup %s: %s' % (path, e))
+        return False
+
+    # no cgroup.kill before Linux 5.14, kill the members until none are left
+    for retry in range(10):
+        try:
+            with open(procs) as f:
+                pids = [int(p) for p in f.read().split()]
+        except OSError as e:
+            adtlog.debug('cannot kill cgroup %s: %s' % (path, e))
+            break
+        if not pids:
+            break
+        for p in pids:
+            try:
+                os.kill(p, signal.SIGKILL)
+            except OSError:
+                pass
+        time.sleep(0.1)
+    return True
+
+
+def cgroup_remove(path, wait=False):
+    '''Remove cgroup path
+
+    If wait is True, give processes which were just killed some time to exit.
+    Otherwise, leave the cgroup alone if there are any (leaked) processes left.
+    '''
+    for retry in range(wait and 20 or 1):
+        try:
+            os.rmdir(path)
+            return
+        except OSError as e:
+            if e.errno != errno.EBUSY:
+                break
+        time.sleep(0.1)
+    adtlog.debug('cannot remove cgroup %s, leaking it' % path)
@@ -0,0 +1,146 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import glob
+import json
+import os
+import stat
+import tempfile
+import time
+
+from reprotest.compare import scan_tree
+from reprotest.utils import parse_sha256sum_line, sha256_file
+
+# bumped on incompatible changes of the file format
+FORMAT_VERSION = 1
+
+# suffixes of the diff reports saved in --store-dir, see diff_dists()
+REPORT_SUFFIXES = ('.diff', '.summary', '.diffoscope.out')
+
+
+def artifacts(dist, manifest=None, jobs=1):
+    """Return the path, size and SHA-256 of every file below dist.
+
+    The hashes are read from manifest, as written by store.ObjectStore, if
+    given; otherwise the files are hashed on up to jobs threads.
+    """
+    digests = {}
+    if manifest and os.path.exists(manifest):
+        with open(manifest) as f:
+            for line in f:
+                digest, relpath = parse_sha256sum_line(line)
+                digests[relpath] = digest
+    files = sorted((relpath, st.st_size) for relpath, st in scan_tree(dist).items()
+                   if stat.S_ISREG(st.st_mode))
+    missing = [relpath for relpath, _ in files if relpath not in digests]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        digests.update(zip(missing, pool.map(
+            lambda p: sha256_file(os.path.join(dist, p)), missing)))
+    return [collections.OrderedDict([("path", relpath), ("size", size),
+                                     ("sha256", digests[relpath])])
+            for relpath, size in files]
+
+
+def json_value(value):
+    """Convert value, e.g. a variation of a VariationSpec, to plain JSON types.
+
+    Namedtuples become objects and sequences become lists; anything else that
+    JSON has no type for becomes its string form.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, '_asdict'):
+        value = value._asdict()
+    if isinstance(value, dict):
+        return collections.OrderedDict((str(k), json_value(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [json_value(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(json_value(v) for v in value)
+    return str(value)
+
+
+def reports(store_dir, name):
+    """Return the paths of the diff reports of build name in store_dir."""
+    if not store_dir:
+        return []
+    return sorted(p for p in glob.glob(os.path.join(glob.escape(store_dir), glob.escape(name) + '.*'))
+                  if os.path.basename(p)[len(name):].startswith(REPORT_SUFFIXES))
+
+
+class ResultsFile(object):
+    """Machine-readable results of a run, as a JSON file.
+
+    The file is rewritten as each build and diff finishes, so it has the
+    results so far if reprotest is interrupted. Builds may run in other
+    processes, so every update locks the directory of the file, reads it,
+    and replaces it atomically.
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _write(self, data):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.filename),
+                                   prefix='.' + os.path.basename(self.filename))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.write("\n")
+        os.replace(tmp, self.filename)
+
+    def _update(self, update):
+        with self._locked():
+            with open(self.filename) as f:
+                data = json.load(f, object_pairs_hook=collections.OrderedDict)
+            update(data)
+            self._write(data)
+
+    def start(self, mode, store_dir=None):
+        with self._locked():
+            self._write(collections.OrderedDict([
+                ("format", FORMAT_VERSION),
+                ("mode", mode),
+                ("store_dir", store_dir and os.path.abspath(store_dir)),
+                ("started", time.time()),
+                ("builds", collections.OrderedDict()),
+                ("diffs", collections.OrderedDict()),
+                ("verdict", None),
+            ]))
+
+    def add_build(self, name, var, duration, dist, manifest=None, jobs=1):
+        build = collections.OrderedDict([
+            ("spec", json_value(collections.OrderedDict(sorted(var.spec.__dict__.items())))),
+            ("duration", duration),
+            ("artifacts", artifacts(dist, manifest, jobs)),
+        ])
+        self._update(lambda data: data["builds"].__setitem__(name, build))
+
+    def add_diff(self, name, control, retcode, duration, store_dir=None):
+        diff = collections.OrderedDict([
+            ("control", control),
+            ("retcode", retcode),
+            ("duration", duration),
+            ("reports", reports(store_dir, name)),
+        ])
+        self._update(lambda data: data["diffs"].__setitem__(name, diff))
+
+    def finish(self, retcode):
+        verdict = {0: "reproducible", 1: "unreproducible"}.get(retcode, "error")
+        def update(data):
+            data["finished"] = time.time()
+            data["retcode"] = retcode
+            data["verdict"] = verdict
+        self._update(update)
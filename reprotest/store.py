@@ -0,0 +1,115 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+
+from reprotest.utils import sha256_file, sha256sum_line
+
+logger = logging.getLogger(__name__)
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+
+def same_metadata(st_a, st_b):
+    return ((st_a.st_mode, st_a.st_uid, st_a.st_gid, st_a.st_mtime_ns) ==
+            (st_b.st_mode, st_b.st_uid, st_b.st_gid, st_b.st_mtime_ns))
+
+
+def reflink(src, dst):
+    """Make dst share the data blocks of src, keeping dst's metadata.
+
+    Raises OSError if the file system does not support that.
+    """
+    tmp = dst + '.reprotest-tmp'
+    try:
+        with open(src, 'rb') as s, open(tmp, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        shutil.copystat(dst, tmp)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def hardlink(src, dst):
+    tmp = dst + '.reprotest-tmp'
+    os.link(src, tmp)
+    os.replace(tmp, dst)
+
+
+class ObjectStore(object):
+    """Content-addressed store for the artifacts of builds.
+
+    Each distinct file is kept once, as objects/<sha256>. The files of every
+    build that was added are hardlinks to these, or reflinks if their
+    metadata differs, as that is part of what we compare. The objects
+    directory may be shared between runs, as long as it is on the same file
+    system as the builds; if it is not, nothing is deduplicated.
+    """
+
+    def __init__(self, objects_dir):
+        self.objects_dir = objects_dir
+        self.deduped = 0  # bytes
+        self.cross_device = False
+        os.makedirs(objects_dir, exist_ok=True)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    def add_file(self, path):
+        """Dedupe the file at path against the store; return its SHA-256."""
+        digest = sha256_file(path)
+        if self.cross_device:
+            return digest
+        obj = self.object_path(digest)
+        try:
+            # new content: the file itself becomes the object
+            os.link(path, obj)
+            return digest
+        except FileExistsError:
+            pass
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            logger.warning("not deduplicating the artifacts, %s is not on the same "
+                           "file system as %s", self.objects_dir, path)
+            self.cross_device = True
+            return digest
+        st, st_obj = os.stat(path), os.stat(obj)
+        if (st.st_dev, st.st_ino) == (st_obj.st_dev, st_obj.st_ino):
+            return digest
+        try:
+            if same_metadata(st, st_obj):
+                hardlink(obj, path)
+            else:
+                reflink(obj, path)
+            self.deduped += st.st_size
+        except OSError as e:
+            logger.debug("not deduplicating %s: %s", path, e)
+        return digest
+
+    def add_tree(self, tree, manifest):
+        """Add all regular files below tree, and write their manifest.
+
+        The manifest lists the SHA-256 and path relative to tree of each file,
+        in the format of sha256sum(1), including its escaping of names.
+        """
+        deduped = self.deduped
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(tree):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                path = os.path.join(dirpath, fn)
+                if os.path.islink(path) or not os.path.isfile(path):
+                    continue
+                entries.append((self.add_file(path), os.path.relpath(path, tree)))
+        with open(manifest, 'w') as f:
+            for digest, relpath in entries:
+                f.write(sha256sum_line(digest, relpath))
+        logger.info("stored %s files of %s in %s, %s bytes of them deduplicated",
+                    len(entries), tree, self.objects_dir, self.deduped - deduped)
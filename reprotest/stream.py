@@ -0,0 +1,136 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import bz2
+import collections
+import gzip
+import lzma
+import os
+import selectors
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def _open_zstd(filename, mode):
+    f = open(filename, mode)
+    return zstandard.ZstdCompressor().stream_writer(f, closefd=True)
+
+
+# name -> (opener, filename suffix)
+COMPRESSIONS = collections.OrderedDict([
+    ('none', (open, '')),
+    ('gzip', (gzip.open, '.gz')),
+    ('xz', (lzma.open, '.xz')),
+    ('bzip2', (bz2.open, '.bz2')),
+])
+if zstandard is not None:
+    COMPRESSIONS['zstd'] = (_open_zstd, '.zst')
+
+
+def open_log(filename, compression='none', max_size=None):
+    """Open filename plus the suffix for compression, for writing bytes.
+
+    If max_size is given, only that many bytes are written to it; see
+    CappedWriter.
+    """
+    opener, suffix = COMPRESSIONS[compression]
+    f = opener(filename + suffix, 'wb')
+    return f if max_size is None else CappedWriter(f, max_size)
+
+
+class CappedWriter(object):
+    """Write at most max_size bytes to the binary file f.
+
+    Anything after that is dropped, and a line saying how much was dropped
+    is added on close.
+    """
+
+    def __init__(self, f, max_size):
+        self.f = f
+        self.max_size = max_size
+        self.written = 0
+        self.dropped = 0
+
+    def write(self, data):
+        room = max(self.max_size - self.written, 0)
+        if len(data) > room:
+            self.dropped += len(data) - room
+            data = data[:room]
+        if data:
+            self.f.write(data)
+            self.written += len(data)
+        return len(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        if self.dropped:
+            self.f.write(b'\n[reprotest: truncated after %d bytes, %d more bytes were not saved]\n'
+                         % (self.written, self.dropped))
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Tee(object):
+    """Copy a byte stream to several binary files, keeping a bounded tail.
+
+    Only the last tail_lines lines (each cut to max_line bytes) are kept in
+    memory, so arbitrarily long output can be streamed through this.
+    """
+
+    def __init__(self, *outputs, tail_lines=50, max_line=1024, bufsize=65536):
+        self.outputs = outputs
+        self.tail_lines = collections.deque(maxlen=tail_lines)
+        self.max_line = max_line
+        self.bufsize = bufsize
+        self.partial = b''
+
+    def write(self, data):
+        for output in self.outputs:
+            output.write(data)
+            output.flush()
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()[-self.max_line:]
+        self.tail_lines.extend(l[-self.max_line:] for l in lines[-self.tail_lines.maxlen:])
+
+    def flush(self):
+        for output in self.outputs:
+            output.flush()
+
+    def pump(self, f):
+        """Copy everything from the file object f until EOF."""
+        pump({f: self}, self.bufsize)
+
+    def tail(self):
+        """Return the last lines written, as a string."""
+        lines = list(self.tail_lines)
+        if self.partial:
+            lines.append(self.partial)
+        return b'\n'.join(lines).decode('utf-8', 'replace')
+
+
+def pump(tees, bufsize=65536):
+    """Copy everything from each file object in tees to its Tee until EOF.
+
+    The files, e.g. the stdout and stderr pipes of a process, are read as
+    data arrives on them, so they can share Tees and outputs.
+    """
+    with selectors.DefaultSelector() as sel:
+        for f, tee in tees.items():
+            sel.register(f, selectors.EVENT_READ, tee)
+        while sel.get_map():
+            for key, _ in sel.select():
+                data = os.read(key.fd, bufsize)
+                if data:
+                    key.data.write(data)
+                else:
+                    sel.unregister(key.fileobj)
@@ -2,7 +2,12 @@
 # For details: reprotest/debian/copyright
 
 import collections
+import concurrent.futures
 import functools
+import hashlib
+import mmap
+import os
+import re
 
 
 class AttributeFunctor(collections.namedtuple('_AttributeFunctor', 'x f')):
@@ -39,3 +44,49 @@ class AttributeReplacer(object):
             lambda v, p: p[0]._replace(**{p[1]: v}),
             reversed(parents[:-1]), result)
 
+
+
+def sha256_file(path, bufsize=1 << 20):
+    """Return the hex SHA-256 of the contents of the file at path."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > bufsize:
+            # hash the whole file in one call, which releases the GIL
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+        else:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def sha256sums(paths, cwd='.', jobs=1):
+    """Return the SHA256SUMS of paths, sorted, in the format of sha256sum(1).
+
+    Relative paths are relative to cwd. The files are hashed on up to jobs
+    threads.
+    """
+    paths = sorted(paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        digests = list(pool.map(lambda p: sha256_file(os.path.join(cwd, p)), paths))
+    return "".join(sha256sum_line(digest, path) for path, digest in zip(paths, digests))
+
+
+def sha256sum_line(digest, path):
+    """Return the line of sha256sum(1) output for path."""
+    if '\\' in path or '\n' in path:
+        # escaped like sha256sum does, so that sha256sum -c understands it
+        path = path.replace('\\', '\\\\').replace('\n', '\\n')
+        digest = '\\' + digest
+    return "%s  %s\n" % (digest, path)
+
+
+def parse_sha256sum_line(line):
+    """Return (digest, path) of a line of sha256sum(1) output."""
+    line = line.rstrip('\n')
+    escaped = line.startswith('\\')
+    if escaped:
+        line = line[1:]
+    digest, _, path = line.partition('  ')
+    if escaped:
+        path = re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), path)
+    return digest, path
@@ -0,0 +1,55 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import subprocess
+
+import pytest
+
+from reprotest.lib import adt_testbed, adtlog
+
+
+def scripted_testbed(replies, pipelined=True):
+    """A Testbed whose virt server gives replies, whatever it is sent."""
+    testbed = adt_testbed.Testbed(['null'], None, 'user', host_distro='debian')
+    testbed.sp = subprocess.Popen(
+        ['sh', '-c', 'printf "%s"; cat >/dev/null' % replies],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+    testbed.pipelined = pipelined
+    return testbed
+
+
+def test_command_wait_out_of_order():
+    testbed = scripted_testbed(r'@2 ok b\n@1 ok a%%20b\nok\n')
+    t1 = testbed.command_async('copydown', ('x y', 'z'))
+    t2 = testbed.command_async('copyup', ('z', 'x'))
+    assert testbed.lastsend == '@2 copyup z x'
+    # the reply to the second request comes first, and is kept for later
+    assert testbed.command_wait(t1, 1) == ['a b']
+    assert testbed.command('revert') == []
+    assert testbed.command_wait(t2, 1, unquote=False) == ['b']
+    assert testbed.replies == {}
+    testbed.stop()
+
+
+def test_command_wait_failed():
+    testbed = scripted_testbed(r'@1 failed\n')
+    tag = testbed.command_async('copyup', ('z', 'x'))
+    with pytest.raises(adtlog.TestbedFailure, match="got `failed'"):
+        testbed.command_wait(tag)
+
+
+def test_command_wait_untagged():
+    testbed = scripted_testbed(r'ok\n')
+    tag = testbed.command_async('copyup', ('z', 'x'))
+    with pytest.raises(adtlog.TestbedFailure, match="untagged reply"):
+        testbed.command_wait(tag)
+
+
+def test_command_async_not_pipelined():
+    testbed = scripted_testbed(r'ok a\nok\n', pipelined=False)
+    tag = testbed.command_async('copydown', ('x', 'z'))
+    # without pipelining, the command ran right away
+    assert testbed.lastsend == 'copydown x z'
+    assert testbed.command('revert') == []
+    assert testbed.command_wait(tag, 1) == ['a']
+    testbed.stop()
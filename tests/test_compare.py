@@ -0,0 +1,82 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import io
+import os
+import tarfile
+import zipfile
+
+from reprotest.compare import compare_archives, compare_trees, format_differences, same_contents
+
+
+def test_same_contents(tmpdir):
+    a, b = tmpdir.join('a'), tmpdir.join('b')
+    for content in [b'', b'x' * 100]:
+        a.write_binary(content)
+        b.write_binary(content)
+        assert same_contents(str(a), str(b), chunk_size=7)
+    b.write_binary(b'x' * 99 + b'y')
+    assert not same_contents(str(a), str(b), chunk_size=7)
+
+
+def test_compare_trees(tmpdir):
+    for build in ('control', 'experiment-1'):
+        tmpdir.join(build, 'same').write('same', ensure=True)
+        tmpdir.join(build, 'sub', 'contents').write(build[0], ensure=True)
+        tmpdir.join(build, 'size').write(build)
+        os.symlink(build, str(tmpdir.join(build, 'link')))
+    tmpdir.join('control', 'sub', 'only').write('', ensure=True)
+    # permissions are ignored, like with diff -r
+    tmpdir.join('experiment-1', 'same').chmod(0o600)
+
+    control, experiment = str(tmpdir.join('control')), str(tmpdir.join('experiment-1'))
+    differences = compare_trees(control, experiment, jobs=2)
+    assert differences == [
+        ('link', 'symlink target'),
+        ('size', 'size 7 != 12'),
+        ('sub/contents', 'contents'),
+        ('sub/only', 'only in %s' % control),
+    ]
+    assert len(format_differences(differences, control, experiment).splitlines()) == 5
+    assert compare_trees(control, control) == []
+    assert format_differences([], control, control) == ""
+
+
+def write_tar_gz(path, members):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+def write_ar(path, members):
+    with open(path, 'wb') as f:
+        f.write(b'!<arch>\n')
+        for name, content in members.items():
+            f.write(b'%-16s%-12s%-6s%-6s%-8s%-10s`\n' % (
+                name.encode() + b'/', b'0', b'0', b'0', b'100644', str(len(content)).encode()))
+            f.write(content + b'\n' * (len(content) % 2))
+
+
+def test_compare_archives(tmpdir):
+    for build, lib in [('control', b'lib'), ('experiment-1', b'lib2')]:
+        tmpdir.join(build).ensure(dir=True)
+        data = str(tmpdir.join(build, 'data.tar.gz'))
+        write_tar_gz(data, {'./usr/lib/foo.so': lib, './usr/share/doc': b'doc'})
+        with open(data, 'rb') as f:
+            write_ar(str(tmpdir.join(build, 'foo.deb')),
+                     {'debian-binary': b'2.0\n', 'data.tar.gz': f.read()})
+        with zipfile.ZipFile(str(tmpdir.join(build, 'foo.jar')), 'w') as z:
+            z.writestr('same.class', b'same')
+            # only the timestamp differs
+            z.writestr(zipfile.ZipInfo('stamp.class', (1980 + len(lib), 1, 1, 0, 0, 0)), b'same')
+        os.remove(data)
+
+    control, experiment = str(tmpdir.join('control')), str(tmpdir.join('experiment-1'))
+    assert compare_archives(os.path.join(control, 'foo.deb'), os.path.join(experiment, 'foo.deb')) \
+        == ['data.tar.gz:/usr/lib/foo.so']
+    assert compare_trees(control, experiment) == [
+        ('foo.deb', 'members: data.tar.gz:/usr/lib/foo.so'),
+        ('foo.jar', 'archive metadata only'),
+    ]
@@ -0,0 +1,41 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import os
+
+from reprotest.diffcache import DiffCache, tree_digest
+
+
+def test_tree_digest(tmpdir):
+    tmpdir.join('a', 'sub', 'file').write('content', ensure=True)
+    tmpdir.join('b', 'sub', 'file').write('content', ensure=True)
+    a, b = str(tmpdir.join('a')), str(tmpdir.join('b'))
+    os.utime(os.path.join(b, 'sub', 'file'), (0, 0))
+    assert tree_digest(a) == tree_digest(b, jobs=2)
+    assert tree_digest(a, metadata=True) != tree_digest(b, metadata=True)
+    tmpdir.join('b', 'sub', 'file').write('changed')
+    assert tree_digest(a) != tree_digest(b)
+
+
+def get(cache, key, dist_0, dist_1):
+    cached = cache.get(key, dist_0, dist_1)
+    return cached and (cached[0], b''.join(cached[1]))
+
+
+def test_diff_cache(tmpdir):
+    cache = DiffCache(str(tmpdir.join('cache')), max_size=1 << 20)
+    assert cache.get('k1', '/old/control', '/old/experiment-1') is None
+    tmpdir.join('output').write('--- /old/control\n+++ /old/experiment-1\n')
+    cache.put('k1', '/old/control', '/old/experiment-1', 1, str(tmpdir.join('output')))
+    assert get(cache, 'k1', '/new/control', '/new/experiment-1') == \
+        (1, b'--- /new/control\n+++ /new/experiment-1\n')
+
+    # the least recently used entry goes first
+    k1 = [os.path.join(cache.cache_dir, f) for f in ('k1.json', 'k1.out.xz')]
+    cache.max_size = sum(os.path.getsize(f) for f in k1)
+    for f in k1:
+        os.utime(f, (0, 0))
+    tmpdir.join('output').write('')
+    cache.put('k2', '/c', '/e', 0, str(tmpdir.join('output')))
+    assert cache.get('k1', '/c', '/e') is None
+    assert get(cache, 'k2', '/c', '/e') == (0, b'')
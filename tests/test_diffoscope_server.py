@@ -0,0 +1,29 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import os
+import subprocess
+
+from reprotest.diffoscope_server import DiffoscopeServer
+
+
+def test_diffoscope_server(tmpdir, monkeypatch):
+    # a stand-in for diffoscope, which the server imports
+    tmpdir.join('diffoscope', '__init__.py').write('', ensure=True)
+    tmpdir.join('diffoscope', 'main.py').write(
+        'import os, sys\n'
+        'def main(args):\n'
+        '    print(os.getcwd(), *args)\n'
+        '    sys.exit(1 if args[0] != args[1] else 0)\n')
+    monkeypatch.setenv('PYTHONPATH', str(tmpdir))
+
+    server = DiffoscopeServer()
+    try:
+        r = server.run(['diffoscope', 'a', 'b'], stdout=subprocess.PIPE, cwd=str(tmpdir))
+        assert (r.returncode, r.stdout) == (1, b'%s a b\n' % os.fsencode(str(tmpdir)))
+        with tmpdir.join('out').open('wb') as f:
+            assert server.run(['diffoscope', 'a', 'a'], stdout=f).returncode == 0
+        assert tmpdir.join('out').read() == '%s a a\n' % os.getcwd()
+    finally:
+        server.close()
+    assert server.proc is None
@@ -9,7 +9,9 @@ import sys
 
 import pytest
 import reprotest
+from reprotest import benchmark
 from reprotest.build import VariationSpec, Variations, VARIATIONS
+from reprotest.utils import sha256sums
 
 REPROTEST = [sys.executable, "-m", "reprotest", "--no-diffoscope", "--min-cpus", "1"]
 REPROTEST_TEST_SERVERS = os.getenv("REPROTEST_TEST_SERVERS", "null").split(",")
@@ -49,6 +51,8 @@ def virtual_server(request):
         return [request.param, 'stable-amd64']
     elif request.param == 'qemu':
         return [request.param, os.path.expanduser('~/linux/reproducible_builds/adt-sid.img')]
+    elif request.param == 'unshare':
+        return [request.param, os.path.expanduser('~/linux/reproducible_builds/sid-rootfs')]
     else:
         raise ValueError(request.param)
 
@@ -58,6 +62,32 @@ def test_simple_builds(virtual_server):
         check_reproducibility('python3 mock_failure.py', virtual_server)
     check_reproducibility('python3 mock_build.py irreproducible', virtual_server, False)
 
+def test_compare_in_testbed(virtual_server):
+    for command, reproducible in [('python3 mock_build.py', True),
+                                  ('python3 mock_build.py irreproducible', False)]:
+        assert reproducible == reprotest.check(
+            reprotest.TestArgs.of(command, 'tests', 'artifact', compare_in_testbed=True),
+            reprotest.TestbedArgs.of(virtual_server),
+            Variations.of(VariationSpec.default(TEST_VARIATIONS)))
+
+def test_copyup_differing_non_utf8(tmpdir):
+    name = os.fsdecode(b'caf\xe9')
+    with reprotest.start_testbed(['null'], str(tmpdir.mkdir('scratch'))) as testbed:
+        builds = []
+        for build_name, content in [('control', 'a'), ('experiment-1', 'b')]:
+            bctx = reprotest.BuildContext(testbed.scratch, str(tmpdir), None, build_name, None)
+            os.makedirs(bctx.testbed_dist)
+            for f, c in [(name, content), ('same', 'same')]:
+                with open(os.path.join(bctx.testbed_dist, f), 'w') as f:
+                    f.write(c)
+            builds.append((bctx, bctx.testbed_manifest(testbed)))
+        (reference, ref_manifest), (bctx, manifest) = builds
+        assert manifest[name][3] != ref_manifest[name][3]
+        reference.copyup(testbed)
+        bctx.copyup_differing(testbed, reference, ref_manifest, manifest)
+    assert tmpdir.join('experiment-1', name).read() == 'b'
+    assert tmpdir.join('experiment-1', 'same').read() == 'same'
+
 @contextlib.contextmanager
 def setup_logging(debug):
     logger = logging.getLogger()
@@ -89,6 +119,10 @@ def test_variations(virtual_server, captures):
     with setup_logging(False):
         check_reproducibility('python3 mock_build.py ' + captures, virtual_server, expected)
 
+def test_benchmark(virtual_server):
+    results = benchmark.benchmark_server(virtual_server, copy_size=1 << 20)
+    assert list(results) == benchmark.STEPS
+
 @pytest.mark.need_builddeps
 def test_self_build(virtual_server):
     # at time of writing (2016-09-23) these are not expected to reproduce;
@@ -126,6 +160,122 @@ def test_command_lines():
     _, testbed_args, _ = check_command_line(". -- schroot unstable-amd64-sbuild".split(), 0)
     assert testbed_args.virtual_server_args == ['schroot', 'unstable-amd64-sbuild']
 
+def test_split_budget():
+    testbed_args = reprotest.TestbedArgs.of(cpu_budget=[0, 1, 2, 3, 8], memory_budget=1000)
+    parts = testbed_args.split_budget(2)
+    assert [p.cpu_budget for p in parts] == [[0, 1], [2, 3, 8]]
+    assert [p.memory_budget for p in parts] == [500, 500]
+    assert reprotest.TestbedArgs.of().split_budget(2) == [reprotest.TestbedArgs.of()] * 2
+
+def test_cgroup_limits():
+    from reprotest.lib import adt_testbed
+    limit = str(256 << 20)
+    cgroup = adt_testbed.cgroup_create({"memory.max": limit})
+    if not cgroup:
+        pytest.skip("cannot create cgroups")
+    if not os.path.exists(os.path.join(cgroup, "memory.max")):
+        adt_testbed.cgroup_remove(cgroup)
+        adt_testbed.cgroup_restore()
+        pytest.skip("cannot enable the memory controller")
+    try:
+        out = subprocess.check_output(adt_testbed.cgroup_wrap(cgroup, ["cat", "/proc/self/cgroup"]))
+        assert out.decode().rstrip().endswith("/" + os.path.basename(cgroup))
+        with open(os.path.join(cgroup, "memory.max")) as f:
+            assert f.read().strip() == limit
+    finally:
+        adt_testbed.cgroup_remove(cgroup, wait=True)
+        adt_testbed.cgroup_restore()
+
+def test_scratch_dir(tmpdir):
+    assert reprotest.scratch_size_hint(os.path.join(os.path.dirname(__file__), 'mock_build.py')) > 0
+    assert reprotest.scratch_dir_for(None, 0) is None
+    assert reprotest.scratch_dir_for(str(tmpdir), 0) == str(tmpdir)
+    assert reprotest.scratch_dir_for(str(tmpdir), 1 << 60) is None
+    assert reprotest.server_uses_size_hint(['null', '--tmpfs=4G'])
+    assert not reprotest.server_uses_size_hint(['null'])
+    assert reprotest.TestArgs.of('true', '.', 'out').host_scratch_dir() is None
+
+def test_sha256sums(tmpdir):
+    for name in ["b", "a/c", "new\nline", "back\\slash"]:
+        tmpdir.join(name).write(name, ensure=True)
+    tmpdir.join("big").write("x" * (3 << 20))
+    sums = sha256sums(["b", "a/c", "big", "new\nline", "back\\slash"], str(tmpdir), 2)
+    assert [l.split()[1] for l in sums.splitlines()] == ["a/c", "b", "back\\\\slash", "big", "new\\nline"]
+    assert 0 == subprocess.run(["sha256sum", "-c", "--quiet"], input=sums.encode(),
+                               cwd=str(tmpdir)).returncode
+
+def test_diffoscope_ignores_metadata():
+    assert reprotest.diffoscope_ignores_metadata(['diffoscope', '--exclude-directory-metadata'])
+    assert not reprotest.diffoscope_ignores_metadata(['diffoscope'])
+    assert not reprotest.diffoscope_ignores_metadata(
+        ['diffoscope', '--exclude-directory-metadata', '--no-exclude-directory-metadata'])
+    assert reprotest.diffoscope_ignores_metadata(
+        ['diffoscope', '--exclude-directory-metadata', 'recursive', '--html', '{0}.html'])
+    assert reprotest.diffoscope_ignores_metadata(
+        ['diffoscope', '--exclude-directory-metadata', '--html', '{0}.html'])
+    assert not reprotest.diffoscope_ignores_metadata(
+        ['diffoscope', '--exclude-directory-metadata', 'no'])
+    assert not reprotest.diffoscope_ignores_metadata(
+        ['diffoscope', '--exclude-directory-metadata=no'])
+    assert not reprotest.diffoscope_ignores_metadata(
+        ['diffoscope', '--exclude-directory-metadata', 'auto'])
+
+def test_run_or_tee(tmpdir, capfd):
+    r = reprotest.run_or_tee(['seq', '1000'], 'seq.out', str(tmpdir), max_size=100)
+    assert r.returncode == 0
+    assert capfd.readouterr().out.splitlines()[-1] == '1000'
+    assert tmpdir.join('seq.out').read().splitlines()[-1].startswith('[reprotest: truncated')
+    with tmpdir.join('shown').open('w+b') as shown:
+        r = reprotest.run_or_tee(['echo', 'hi'], 'echo.out', str(tmpdir), echo=shown,
+                                 compression='gzip')
+        shown.seek(0)
+        assert shown.read() == b'hi\n'
+    assert r.returncode == 0
+    assert capfd.readouterr().out == ''
+    assert tmpdir.join('echo.out.gz').check()
+
+def test_run_diffoscope_cache_max_size(tmpdir, capfd):
+    from reprotest.diffcache import DiffCache
+    cache = DiffCache(str(tmpdir.join('cache')))
+    tmpdir.join('control', 'f').write('a', ensure=True)
+    tmpdir.join('experiment-1', 'f').write('b', ensure=True)
+    dists = str(tmpdir.join('control')), str(tmpdir.join('experiment-1'))
+    for run in range(2):
+        r = reprotest.run_diffoscope(*dists, ['sh', '-c', 'seq 1000; exit 1', 'sh'],
+                                     str(tmpdir.join('store%i' % run).mkdir()), cache=cache,
+                                     store_opts={'max_size': 100})
+        assert r.returncode == 1
+        # only the saved output is cut, also when it comes from the cache
+        assert capfd.readouterr().out.splitlines()[-1] == '1000'
+        saved = tmpdir.join('store%i' % run, 'experiment-1.diffoscope.out').read()
+        assert saved.splitlines()[-1].startswith('[reprotest: truncated')
+
+def test_run_diffs_parallel(tmpdir, capfd):
+    bnames = ["control", "experiment-1", "experiment-2"]
+    for bname, content in zip(bnames, ["a\n", "a\n", "b\n"]):
+        tmpdir.join(bname, "artifact").write(content, ensure=True)
+    # experiments finishing before the control
+    builds = [(bname, str(tmpdir.join(bname))) for bname in reversed(bnames)]
+    dists, retcodes = reprotest.run_diffs_parallel(builds, bnames, None, str(tmpdir), 2)
+    assert list(retcodes.items()) == [("experiment-1", 0), ("experiment-2", 1)]
+    assert os.path.islink(dists["experiment-1"])
+    assert "artifact (contents)" in tmpdir.join("experiment-2.diff").read()
+    assert "artifact (contents)" in capfd.readouterr().out
+
+def test_diff_summary(tmpdir, capfd):
+    for bname in ["control", "experiment-1"]:
+        tmpdir.join(bname, "artifact").write("a\n", ensure=True)
+    dists = [str(tmpdir.join("control")), str(tmpdir.join("experiment-1"))]
+    # stands in for diffoscope, which the summary makes unnecessary here
+    args = ['sh', '-c', 'echo diffoscope ran; exit 1', 'sh', '--exclude-directory-metadata']
+    assert reprotest.run_diff(*dists, args, None) == 1
+    assert "diffoscope ran" in capfd.readouterr().out
+    assert reprotest.run_diff(*dists, args, None, summary=True) == 0
+    assert "diffoscope ran" not in capfd.readouterr().out
+    # without --exclude-directory-metadata, diffoscope still has to run
+    assert reprotest.run_diff(*dists, args[:-1], None, summary=True) == 1
+    assert "diffoscope ran" in capfd.readouterr().out
+
 # TODO: don't call it if we don't have debian/, e.g. for other distros
 @pytest.mark.need_builddeps
 def test_debian_build(virtual_server):
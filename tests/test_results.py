@@ -0,0 +1,49 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import json
+
+from reprotest.build import TimeVariation, UserGroupVariation, VariationSpec, Variations
+from reprotest.results import ResultsFile
+
+
+def test_results_file(tmpdir):
+    tmpdir.join('store', 'control', 'artifact').write('a', ensure=True)
+    tmpdir.join('store', 'experiment-1.diff').write('')
+    tmpdir.join('store', 'experiment-1.build.log').write('')
+    store_dir = str(tmpdir.join('store'))
+    results = ResultsFile(str(tmpdir.join('results.json')))
+
+    results.start('check', store_dir)
+    var = Variations.of(VariationSpec.default())[0]
+    results.add_build('control', var, 1.5, str(tmpdir.join('store', 'control')))
+    # partial results are there before the run finishes
+    data = json.loads(tmpdir.join('results.json').read())
+    assert data['verdict'] is None
+    assert data['builds']['control']['artifacts'] == [{
+        'path': 'artifact', 'size': 1,
+        'sha256': 'ca978112ca1bbdcafac231b39a23dc4da786eff8147c4e72b9807785afee48bb'}]
+
+    results.add_diff('experiment-1', 'control', 1, 0.5, store_dir)
+    results.finish(1)
+    data = json.loads(tmpdir.join('results.json').read())
+    assert data['diffs']['experiment-1']['reports'] == [str(tmpdir.join('store', 'experiment-1.diff'))]
+    assert (data['retcode'], data['verdict']) == (1, 'unreproducible')
+
+
+def test_results_file_spec(tmpdir):
+    tmpdir.join('dist', 'artifact').write('a', ensure=True)
+    results = ResultsFile(str(tmpdir.join('results.json')))
+    results.start('check')
+    spec = VariationSpec.default().extend([
+        'time.faketimes+=@2020-01-01', 'user_group.available+=builduser:builduser', '-home'])
+    results.add_build('experiment-1', Variations.of(spec)[1], 1.5, str(tmpdir.join('dist')))
+
+    data = json.loads(tmpdir.join('results.json').read())['builds']['experiment-1']['spec']
+    assert 'home' not in data
+    assert data['umask'] is True
+    assert data['time'] == {'faketimes': ['@2020-01-01'], 'auto_faketimes': ['SOURCE_DATE_EPOCH']}
+    assert data['environment'] == {'variables': ['REPROTEST_CAPTURE_ENVIRONMENT']}
+    assert data['domain_host'] == {'use_sudo': 0}
+    assert TimeVariation(**data['time']) == spec.time
+    assert UserGroupVariation(**data['user_group']) == spec.user_group
@@ -0,0 +1,56 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import errno
+import os
+
+from reprotest.store import ObjectStore
+from reprotest.utils import parse_sha256sum_line
+
+
+def write(path, content, mode=0o644):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, mode)
+    os.utime(path, (0, 0))
+
+
+def test_object_store(tmpdir):
+    tmpdir = str(tmpdir)
+    for build in ('control', 'experiment-1'):
+        write(os.path.join(tmpdir, build, 'same'), 'same\n')
+        write(os.path.join(tmpdir, build, 'sub', 'differs'), build)
+    # same content, different permissions
+    write(os.path.join(tmpdir, 'control', 'mode'), 'mode\n')
+    write(os.path.join(tmpdir, 'experiment-1', 'mode'), 'mode\n', 0o664)
+
+    objects = ObjectStore(os.path.join(tmpdir, 'objects'))
+    for build in ('control', 'experiment-1'):
+        objects.add_tree(os.path.join(tmpdir, build), os.path.join(tmpdir, build + '.manifest'))
+
+    assert len(os.listdir(objects.objects_dir)) == 4
+    assert os.path.samefile(os.path.join(tmpdir, 'control', 'same'),
+                            os.path.join(tmpdir, 'experiment-1', 'same'))
+    assert not os.path.samefile(os.path.join(tmpdir, 'control', 'mode'),
+                                os.path.join(tmpdir, 'experiment-1', 'mode'))
+    assert os.stat(os.path.join(tmpdir, 'experiment-1', 'mode')).st_mode & 0o777 == 0o664
+    with open(os.path.join(tmpdir, 'control.manifest')) as f:
+        assert [l.split()[1] for l in f] == ['mode', 'same', 'sub/differs']
+
+
+def test_object_store_cross_device(tmpdir, monkeypatch):
+    tmpdir = str(tmpdir)
+    write(os.path.join(tmpdir, 'control', 'new\nline'), 'same\n')
+    write(os.path.join(tmpdir, 'control', 'back\\slash'), 'same\n')
+
+    def link(src, dst):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+    monkeypatch.setattr(os, 'link', link)
+    objects = ObjectStore(os.path.join(tmpdir, 'objects'))
+    objects.add_tree(os.path.join(tmpdir, 'control'), os.path.join(tmpdir, 'control.manifest'))
+
+    assert objects.cross_device
+    assert os.listdir(objects.objects_dir) == []
+    with open(os.path.join(tmpdir, 'control.manifest')) as f:
+        assert [parse_sha256sum_line(l)[1] for l in f] == ['back\\slash', 'new\nline']
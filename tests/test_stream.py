@@ -0,0 +1,58 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import io
+import os
+import subprocess
+
+import pytest
+
+from reprotest.stream import *
+
+
+def test_tee_tail():
+    out = io.BytesIO()
+    tee = Tee(out, tail_lines=3, max_line=8)
+    for i in range(1000):
+        tee.write(b'line %d\n' % i)
+    tee.write(b'a very long partial line')
+    assert out.getvalue().startswith(b'line 0\nline 1\n')
+    assert tee.tail() == 'line 997\nline 998\nline 999\nial line'
+
+
+@pytest.mark.parametrize('compression', list(COMPRESSIONS.keys()))
+def test_open_log(tmpdir, compression):
+    filename = os.path.join(str(tmpdir), 'build.log')
+    with open_log(filename, compression) as f:
+        Tee(f).write(b'hello\n')
+    assert len(os.listdir(str(tmpdir))) == 1
+    opener, suffix = COMPRESSIONS[compression]
+    if compression == 'zstd':
+        with open(filename + suffix, 'rb') as f:
+            with zstandard.ZstdDecompressor().stream_reader(f) as r:
+                assert r.read() == b'hello\n'
+    else:
+        with opener(filename + suffix, 'rb') as f:
+            assert f.read() == b'hello\n'
+
+
+def test_pump():
+    out, err, merged = io.BytesIO(), io.BytesIO(), io.BytesIO()
+    merged_tee = Tee(merged)
+    proc = subprocess.Popen(['sh', '-c', 'echo out; echo err >&2; echo out2'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with proc.stdout, proc.stderr:
+        pump({proc.stdout: Tee(out, merged_tee), proc.stderr: Tee(err, merged_tee)})
+    proc.wait()
+    assert out.getvalue() == b'out\nout2\n'
+    assert err.getvalue() == b'err\n'
+    assert sorted(merged_tee.tail().split('\n')) == ['err', 'out', 'out2']
+
+
+def test_capped_writer(tmpdir):
+    filename = os.path.join(str(tmpdir), 'diff.out')
+    with open_log(filename, max_size=10) as f:
+        Tee(f).write(b'0123456')
+        Tee(f).write(b'789abc')
+    with open(filename, 'rb') as f:
+        assert f.read() == b'0123456789\n[reprotest: truncated after 10 bytes, 3 more bytes were not saved]\n'
@@ -0,0 +1,64 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import io
+import time
+
+from reprotest.lib import VirtSubproc
+
+
+def reply_after(delay, *r):
+    def cmd(c, ce):
+        time.sleep(delay)
+        return list(r)
+    return cmd
+
+
+def fail_with(e):
+    def cmd(c, ce):
+        raise e
+    return cmd
+
+
+def test_run_concurrent(capfd):
+    VirtSubproc.run_concurrent('@1', reply_after(0.5, 'slow'), ['copydown'], ['copydown'])
+    VirtSubproc.run_concurrent('@2', reply_after(0, 'fast'), ['copyup'], ['copyup'])
+    assert sorted(VirtSubproc.concurrent_pending.values()) == ['@1', '@2']
+    VirtSubproc.reap_concurrent()
+    assert VirtSubproc.concurrent_pending == {}
+    # each reply is a line of its own, in the order they finished
+    assert capfd.readouterr().out == '@2 ok fast\n@1 ok slow\n'
+
+
+def test_run_concurrent_errors(capfd):
+    VirtSubproc.run_concurrent('@1', fail_with(VirtSubproc.FailedCmd(['badpkg', 'x'])),
+                               ['copyup'], ['copyup'])
+    VirtSubproc.reap_concurrent()
+    VirtSubproc.run_concurrent('@2', fail_with(VirtSubproc.Quit(1, 'no such file')),
+                               ['copyup'], ['copyup'])
+    VirtSubproc.reap_concurrent()
+    VirtSubproc.run_concurrent('@3', fail_with(OSError('oops')), ['copyup'], ['copyup'])
+    VirtSubproc.reap_concurrent()
+    out, err = capfd.readouterr()
+    assert out == '@1 badpkg x\n@2 failed\n@3 failed\n'
+    assert 'no such file' in err and 'OSError: oops' in err
+
+
+def test_reap_concurrent_nonblocking(capfd):
+    VirtSubproc.run_concurrent('@1', reply_after(0.5), ['copyup'], ['copyup'])
+    VirtSubproc.reap_concurrent(False)
+    assert list(VirtSubproc.concurrent_pending.values()) == ['@1']
+    VirtSubproc.reap_concurrent()
+    assert VirtSubproc.concurrent_pending == {}
+    assert capfd.readouterr().out == '@1 ok\n'
+
+
+def test_command_barrier(monkeypatch, capfd):
+    # a tagged command that is not in concurrent_commands waits for the
+    # concurrent ones and replies with its tag
+    VirtSubproc.run_concurrent('@1', reply_after(0.5), ['copyup'], ['copyup'])
+    monkeypatch.setattr(VirtSubproc, 'cmd_revert', reply_after(0, 'done'), raising=False)
+    monkeypatch.setattr('sys.stdin', io.StringIO('@2 revert\n'))
+    VirtSubproc.command()
+    assert VirtSubproc.concurrent_pending == {}
+    assert capfd.readouterr().out == '@1 ok\n@2 ok done\n'